@@ -1,3 +1,4 @@
+import click
 from flask import Flask, redirect, send_from_directory
 from flask_cors import CORS
 from flask_pymongo import PyMongo
@@ -9,7 +10,9 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_swagger_ui import get_swaggerui_blueprint
 from celery import Celery
+from redis import Redis
 from config import Config
+from app.utils.serializers import FragmentJSONProvider
 
 # Initialize extensions
 mongo = PyMongo()
@@ -19,10 +22,12 @@ socketio = SocketIO()
 cache = Cache()
 limiter = Limiter(key_func=get_remote_address)
 celery = Celery(__name__, broker=Config.CELERY_BROKER_URL)
+redis_client = Redis.from_url(Config.REDIS_URL)
 
 def create_app(config_class=Config):
     app = Flask(__name__, static_folder='static')
     app.config.from_object(config_class)
+    app.json = FragmentJSONProvider(app)
 
     # Initialize CORS
     CORS(app)
@@ -61,6 +66,34 @@ def create_app(config_class=Config):
     app.register_blueprint(coupons_bp, url_prefix='/api/coupons')
     app.register_blueprint(admin_bp, url_prefix='/api/admin')
 
+    # Declared indexes: available as CLI commands, applied on startup if enabled
+    from app.utils.indexes import ensure_indexes, find_collscans
+
+    @app.cli.command('ensure-indexes')
+    def ensure_indexes_command():
+        created, errors = ensure_indexes(mongo.db)
+        for collection, names in created.items():
+            click.echo(f'{collection}: {", ".join(names)}')
+        for collection, error in errors.items():
+            click.echo(f'{collection}: FAILED: {error}', err=True)
+        if errors:
+            raise SystemExit(1)
+
+    @app.cli.command('check-query-plans')
+    def check_query_plans_command():
+        collscans = find_collscans(mongo.db)
+        for name in collscans:
+            click.echo(f'COLLSCAN: {name}')
+        if collscans:
+            raise SystemExit(1)
+        click.echo('All finder queries use an index')
+
+    if app.config['MONGO_ENSURE_INDEXES']:
+        with app.app_context():
+            _, errors = ensure_indexes(mongo.db)
+        for collection, error in errors.items():
+            app.logger.warning(f'Could not ensure MongoDB indexes on {collection}: {error}')
+
     # Configure Swagger UI
     SWAGGER_URL = '/api/docs'
     API_URL = '/static/swagger.json'
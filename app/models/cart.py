@@ -1,7 +1,14 @@
-from datetime import datetime
-from app import mongo
+from datetime import datetime, timedelta
+from app import mongo, redis_client
 from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, ReplaceOne, ReturnDocument
 from app.models.product import Product
+from app.models.cart_store import RedisCartStore
+from app.utils.cache import make_etag
+from config import Config
+
+# Optional hot store; None means carts are read and written in Mongo directly
+cart_store = RedisCartStore(redis_client) if Config.CART_BACKEND == 'redis' else None
 
 class CartItem:
     def __init__(self, product_id, quantity):
@@ -15,7 +22,13 @@ class CartItem:
         }
 
 class Cart:
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING)], unique=True, name='user_id_unique'),
+        IndexModel([('updated_at', ASCENDING)], name='updated_at')
+    ]
+
     def __init__(self, user_id):
+        self.id = None
         self.user_id = user_id
         self.items = []
         self.created_at = datetime.utcnow()
@@ -23,27 +36,36 @@ class Cart:
 
     @staticmethod
     def find_by_user_id(user_id, db):
-        cart_data = db.carts.find_one({'user_id': user_id})
+        if cart_store:
+            cart_data = cart_store.load(db, user_id)
+        else:
+            cart_data = db.carts.find_one({'user_id': user_id})
         if cart_data:
-            cart = Cart(user_id=cart_data['user_id'])
-            cart.id = str(cart_data['_id'])
-            cart.items = [CartItem(**item) for item in cart_data['items']]
-            cart.created_at = cart_data['created_at']
-            cart.updated_at = cart_data['updated_at']
-            return cart
+            return Cart(user_id=cart_data['user_id']).refresh(cart_data)
         return None
 
     def save(self, db):
-        cart_data = {
-            'user_id': self.user_id,
-            'items': [item.to_dict() for item in self.items],
-            'created_at': self.created_at,
-            'updated_at': self.updated_at
-        }
-        result = db.carts.insert_one(cart_data)
-        self.id = str(result.inserted_id)
+        """Create the cart document, or pick up the one a concurrent request just created."""
+        cart_data = db.carts.find_one_and_update(
+            {'user_id': self.user_id},
+            {'$setOnInsert': {
+                'items': [item.to_dict() for item in self.items],
+                'created_at': self.created_at,
+                'updated_at': self.updated_at
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.refresh(cart_data)
+        if cart_store:
+            cart_store.warm(cart_data)
         return self
 
+    def persist(self, db):
+        """Write a cart held in the hot store through to Mongo now (e.g. at checkout)."""
+        if cart_store:
+            cart_store.flush(db, [self.user_id])
+
     def update(self, db):
         cart_data = {
             'items': [item.to_dict() for item in self.items],
@@ -55,71 +77,320 @@ class Cart:
         )
         return result.modified_count > 0
 
+    def refresh(self, cart_data):
+        self.id = str(cart_data['_id'])
+        self.items = [CartItem(**item) for item in cart_data['items']]
+        self.created_at = cart_data['created_at']
+        self.updated_at = cart_data['updated_at']
+        return self
+
     def add_item(self, db, product_id, quantity):
+        quantity = int(quantity)
+
         # Check if product exists and has enough stock
         product = Product.find_by_id(product_id, db)
         if not product or product.stock < quantity:
             return False
 
-        # Check if item already exists in cart
-        for item in self.items:
-            if item.product_id == product_id:
-                new_quantity = item.quantity + quantity
-                if product.stock < new_quantity:
-                    return False
-                item.quantity = new_quantity
-                self.update(db)
-                return True
-
-        # Add new item
-        self.items.append(CartItem(product_id, quantity))
-        self.update(db)
+        # Carts are created lazily, on the first item added
+        if not self.id:
+            self.save(db)
+
+        if cart_store:
+            cart_data = cart_store.add_item(db, self.user_id, product_id, quantity, product.stock)
+            if not cart_data:
+                return False
+            self.refresh(cart_data)
+            return True
+
+        # Bump an existing line, only if the new quantity stays within stock
+        cart_data = db.carts.find_one_and_update(
+            {
+                'user_id': self.user_id,
+                'items': {'$elemMatch': {'product_id': product_id, 'quantity': {'$lte': product.stock - quantity}}}
+            },
+            {'$inc': {'items.$.quantity': quantity}, '$set': {'updated_at': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+
+        # Otherwise append a new line, unless the product is already in the cart
+        if not cart_data:
+            cart_data = db.carts.find_one_and_update(
+                {'user_id': self.user_id, 'items.product_id': {'$ne': product_id}},
+                {'$push': {'items': CartItem(product_id, quantity).to_dict()}, '$set': {'updated_at': datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+
+        if not cart_data:
+            return False
+        self.refresh(cart_data)
         return True
 
     def remove_item(self, db, product_id):
-        self.items = [item for item in self.items if item.product_id != product_id]
-        return self.update(db)
+        if cart_store:
+            cart_data = cart_store.remove_item(db, self.user_id, product_id)
+        else:
+            cart_data = db.carts.find_one_and_update(
+                {'user_id': self.user_id, 'items.product_id': product_id},
+                {'$pull': {'items': {'product_id': product_id}}, '$set': {'updated_at': datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+        if not cart_data:
+            return False
+        self.refresh(cart_data)
+        return True
 
     def update_item_quantity(self, db, product_id, quantity):
+        quantity = int(quantity)
+
         # Check if product exists and has enough stock
         product = Product.find_by_id(product_id, db)
         if not product or product.stock < quantity:
             return False
 
-        # Update item quantity
-        for item in self.items:
-            if item.product_id == product_id:
-                item.quantity = quantity
-                return self.update(db)
-        return False
+        # Update item quantity in place
+        if cart_store:
+            cart_data = cart_store.set_quantity(db, self.user_id, product_id, quantity)
+        else:
+            cart_data = db.carts.find_one_and_update(
+                {'user_id': self.user_id, 'items.product_id': product_id},
+                {'$set': {'items.$.quantity': quantity, 'updated_at': datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+        if not cart_data:
+            return False
+        self.refresh(cart_data)
+        return True
 
     def clear(self, db):
-        self.items = []
-        return self.update(db)
+        if cart_store:
+            cart_data = cart_store.clear(db, self.user_id)
+        else:
+            cart_data = db.carts.find_one_and_update(
+                {'user_id': self.user_id},
+                {'$set': {'items': [], 'updated_at': datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+        if not cart_data:
+            return False
+        self.refresh(cart_data)
+        return True
 
-    def get_total(self, db):
-        total = 0
-        for item in self.items:
-            product = Product.find_by_id(item.product_id, db)
-            if product:
-                total += product.price * item.quantity
-        return total
+    def replace_items(self, db, items, expected_updated_at):
+        """Write a full item list in one update, only if nobody changed the cart meanwhile."""
+        if cart_store:
+            return cart_store.replace_items(db, self.user_id, items, expected_updated_at)
+        return db.carts.find_one_and_update(
+            {'user_id': self.user_id, 'updated_at': expected_updated_at},
+            {'$set': {'items': items, 'updated_at': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
 
-    def to_dict(self, db):
-        items = []
-        for item in self.items:
-            product = Product.find_by_id(item.product_id, db)
-            if product:
-                items.append({
-                    'product': product.to_dict(),
-                    'quantity': item.quantity
+    def apply_operations(self, db, operations, retries=3):
+        """Apply a batch of add/update/remove operations in a single write.
+
+        Every referenced product is loaded with one query. Operations that
+        fail validation are reported and skipped; the rest are written
+        together with an optimistic check on updated_at, reloading and
+        re-applying if another request changed the cart first. Returns one
+        result per operation, in order.
+        """
+        products = Product.find_many([op['product_id'] for op in operations if isinstance(op.get('product_id'), str)], db)
+
+        for _ in range(retries):
+            quantities = {item.product_id: item.quantity for item in self.items}
+            results = []
+            for index, op in enumerate(operations):
+                error = self._apply_operation(quantities, products, op)
+                results.append({
+                    'index': index,
+                    'op': op.get('op'),
+                    'product_id': op.get('product_id'),
+                    'success': error is None,
+                    'error': error
                 })
 
+            if not any(result['success'] for result in results):
+                return results
+
+            items = [CartItem(product_id, quantity).to_dict() for product_id, quantity in quantities.items()]
+            if not self.id:
+                self.save(db)
+                continue
+            cart_data = self.replace_items(db, items, self.updated_at)
+            if cart_data:
+                self.refresh(cart_data)
+                return results
+
+            # The cart changed underneath us; start over from the latest copy
+            latest = Cart.find_by_user_id(self.user_id, db)
+            if not latest:
+                break
+            self.items, self.updated_at = latest.items, latest.updated_at
+
+        return [dict(result, success=False, error='Cart was modified concurrently') for result in results]
+
+    @staticmethod
+    def _apply_operation(quantities, products, op):
+        action = op.get('op')
+        product_id = op.get('product_id')
+        if action not in ['add', 'update', 'remove']:
+            return 'Invalid operation'
+        if not isinstance(product_id, str):
+            return 'Invalid product_id'
+        if action == 'remove':
+            if quantities.pop(product_id, None) is None:
+                return 'Item not found in cart'
+            return None
+
+        try:
+            quantity = int(op.get('quantity'))
+        except (TypeError, ValueError):
+            return 'Invalid quantity'
+        if quantity <= 0:
+            return 'Invalid quantity'
+
+        product = products.get(product_id)
+        if not product:
+            return 'Product not found'
+        if action == 'update' and product_id not in quantities:
+            return 'Item not found in cart'
+
+        new_quantity = quantity if action == 'update' else quantities.get(product_id, 0) + quantity
+        if product.stock < new_quantity:
+            return 'Insufficient stock'
+        quantities[product_id] = new_quantity
+        return None
+
+    def load_products(self, db, fields=None):
+        if fields:
+            # Totals are always priced and validators need updated_at, even
+            # when the caller trims the payload
+            fields = list(fields) + [field for field in ('price', 'updated_at') if field not in fields]
+        return Product.find_many([item.product_id for item in self.items], db, fields)
+
+    def etag(self, products, fields=None):
+        """Changes whenever the cart or any product shown in it changes."""
+        return make_etag(self.id, self.updated_at, fields, sorted(
+            (product_id, product.updated_at) for product_id, product in products.items()
+        ))
+
+    def last_modified(self, products):
+        """Latest updated_at of the cart and the products shown in it."""
+        return max([self.updated_at] + [product.updated_at for product in products.values() if product.updated_at])
+
+    def price(self, db, coupon=None, fields=None, products=None):
+        """Price the cart once; reuse the returned PricedCart for the whole request."""
+        if products is None:
+            products = self.load_products(db, fields)
+        return PricedCart(self, products, coupon)
+
+    def get_total(self, db, products=None):
+        return self.price(db, products=products).subtotal
+
+    def to_dict(self, db, fields=None, products=None):
+        return self.price(db, fields=fields, products=products).to_dict(fields)
+
+    @staticmethod
+    def archive_abandoned(db, days, batch_size=1000):
+        """Move carts untouched for `days` days to carts_archive; returns the number removed.
+
+        Empty carts are simply deleted. A cart updated mid-sweep stays live
+        (its archived copy is overwritten on a later sweep).
+        """
+        # Make sure Mongo has the latest copy of carts held in the hot store
+        if cart_store:
+            cart_store.flush(db)
+
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        removed = 0
+        last_id = None
+        while True:
+            query = {'updated_at': {'$lt': cutoff}}
+            if last_id:
+                query['_id'] = {'$gt': last_id}
+            batch = list(db.carts.find(query).sort('_id', 1).limit(batch_size))
+            if not batch:
+                break
+            last_id = batch[-1]['_id']
+
+            candidates = batch
+            if cart_store:
+                # Skip carts changed in Redis since the flush above
+                idle = set(cart_store.idle([cart_data['user_id'] for cart_data in batch], cutoff))
+                candidates = [cart_data for cart_data in batch if cart_data['user_id'] in idle]
+
+            archived = [cart_data for cart_data in candidates if cart_data['items']]
+            if archived:
+                db.carts_archive.bulk_write([
+                    ReplaceOne({'_id': cart_data['_id']}, dict(cart_data, archived_at=datetime.utcnow()), upsert=True)
+                    for cart_data in archived
+                ], ordered=False)
+
+            if candidates:
+                candidate_ids = [cart_data['_id'] for cart_data in candidates]
+                result = db.carts.delete_many({'_id': {'$in': candidate_ids}, 'updated_at': {'$lt': cutoff}})
+                removed += result.deleted_count
+                if cart_store and result.deleted_count:
+                    kept = {cart_data['_id'] for cart_data in db.carts.find({'_id': {'$in': candidate_ids}}, {'_id': 1})}
+                    cart_store.evict_idle([cart_data['user_id'] for cart_data in candidates if cart_data['_id'] not in kept], cutoff)
+
+            if len(batch) < batch_size:
+                break
+        return removed
+
+class PricedCart:
+    """A cart priced in one pass over its lines.
+
+    Holds the products used, each line total, the subtotal and the coupon
+    discount, so validation, discounting and serialization within one
+    request never re-fetch products or re-add lines.
+    """
+
+    def __init__(self, cart, products, coupon=None):
+        self.cart = cart
+        self.products = products
+        self.lines = []
+        for item in cart.items:
+            product = products.get(item.product_id)
+            if product:
+                self.lines.append((item, product, product.price * item.quantity))
+        self.subtotal = sum(line_total for _, _, line_total in self.lines)
+        self.coupon = None
+        self.discount = 0
+        if coupon:
+            self.apply_coupon(coupon)
+
+    @property
+    def total(self):
+        return self.subtotal - self.discount
+
+    def apply_coupon(self, coupon):
+        """Validate coupon against the subtotal and apply its discount."""
+        is_valid, error_message = coupon.validate(self.subtotal)
+        if not is_valid:
+            return False, error_message
+        self.coupon = coupon
+        self.discount = min(coupon.calculate_discount(self.subtotal), self.subtotal)
+        return True, None
+
+    def to_dict(self, fields=None):
+        cart = self.cart
         return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'items': items,
-            'total': self.get_total(db),
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
-        } 
\ No newline at end of file
+            'id': cart.id,
+            'user_id': cart.user_id,
+            'items': [
+                {
+                    'product': product.to_dict(fields) if fields else product.to_json(),
+                    'quantity': item.quantity,
+                    'line_total': line_total
+                }
+                for item, product, line_total in self.lines
+            ],
+            'subtotal': self.subtotal,
+            'coupon_code': self.coupon.code if self.coupon else None,
+            'discount': self.discount,
+            'total': self.total,
+            'created_at': cart.created_at.isoformat(),
+            'updated_at': cart.updated_at.isoformat()
+        }
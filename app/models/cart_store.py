@@ -0,0 +1,285 @@
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne
+from redis import ResponseError
+
+DIRTY_KEY = 'carts:dirty'
+FLUSHING_KEY = 'carts:flushing'
+
+# Every script takes KEYS = [meta hash, items hash, dirty set] and
+# ARGV = [user_id, updated_at, ttl, ...]. They return -2 when the cart is
+# not loaded in Redis so the caller can warm it from Mongo and retry.
+_TOUCH = """
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[2])
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+"""
+
+ADD_ITEM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -2 end
+local quantity = redis.call('HINCRBY', KEYS[2], ARGV[4], ARGV[5])
+if quantity > tonumber(ARGV[6]) then
+    if quantity == tonumber(ARGV[5]) then
+        redis.call('HDEL', KEYS[2], ARGV[4])
+    else
+        redis.call('HINCRBY', KEYS[2], ARGV[4], -tonumber(ARGV[5]))
+    end
+    return -1
+end
+""" + _TOUCH + """
+return quantity
+"""
+
+SET_QUANTITY_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -2 end
+if redis.call('HEXISTS', KEYS[2], ARGV[4]) == 0 then return 0 end
+redis.call('HSET', KEYS[2], ARGV[4], ARGV[5])
+""" + _TOUCH + """
+return 1
+"""
+
+REMOVE_ITEM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -2 end
+if redis.call('HDEL', KEYS[2], ARGV[4]) == 0 then return 0 end
+""" + _TOUCH + """
+return 1
+"""
+
+CLEAR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -2 end
+redis.call('DEL', KEYS[2])
+""" + _TOUCH + """
+return 1
+"""
+
+REMOVE_QUANTITIES_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -2 end
+for i = 4, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[2], ARGV[i], -tonumber(ARGV[i + 1])) <= 0 then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    end
+end
+""" + _TOUCH + """
+return 1
+"""
+
+REPLACE_ITEMS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -2 end
+if redis.call('HGET', KEYS[1], 'updated_at') ~= ARGV[4] then return 0 end
+redis.call('DEL', KEYS[2])
+for i = 5, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+""" + _TOUCH + """
+return 1
+"""
+
+# KEYS = [meta hash, items hash], ARGV = [id, created_at, updated_at, ttl,
+# product_id, quantity, ...]. Loads a cart unless another request already did.
+WARM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('HSET', KEYS[1], 'id', ARGV[1], 'created_at', ARGV[2], 'updated_at', ARGV[3])
+redis.call('DEL', KEYS[2])
+for i = 5, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+# KEYS = [meta hash, items hash, dirty set, flushing set], ARGV = [user_id, cutoff].
+# Drops a cart only if it has no unflushed changes and is older than cutoff.
+EVICT_IDLE_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 1 or redis.call('SISMEMBER', KEYS[4], ARGV[1]) == 1 then
+    return 0
+end
+local updated_at = redis.call('HGET', KEYS[1], 'updated_at')
+if updated_at and updated_at >= ARGV[2] then return 0 end
+redis.call('DEL', KEYS[1], KEYS[2])
+return 1
+"""
+
+# KEYS = [meta hash, dirty set], ARGV = [user_id, updated_at]. Marks a cart
+# clean only if it has not changed since it was read for the flush.
+MARK_CLEAN_SCRIPT = """
+local updated_at = redis.call('HGET', KEYS[1], 'updated_at')
+if updated_at and updated_at ~= ARGV[2] then return 0 end
+return redis.call('SREM', KEYS[2], ARGV[1])
+"""
+
+class RedisCartStore:
+    """Hot cart store: active carts live in Redis and are written behind to Mongo."""
+
+    def __init__(self, client, ttl=7 * 24 * 3600):
+        self.client = client
+        self.ttl = ttl
+        self._add_item = client.register_script(ADD_ITEM_SCRIPT)
+        self._set_quantity = client.register_script(SET_QUANTITY_SCRIPT)
+        self._remove_item = client.register_script(REMOVE_ITEM_SCRIPT)
+        self._clear = client.register_script(CLEAR_SCRIPT)
+        self._replace_items = client.register_script(REPLACE_ITEMS_SCRIPT)
+        self._remove_quantities = client.register_script(REMOVE_QUANTITIES_SCRIPT)
+        self._warm = client.register_script(WARM_SCRIPT)
+        self._evict_idle = client.register_script(EVICT_IDLE_SCRIPT)
+        self._mark_clean = client.register_script(MARK_CLEAN_SCRIPT)
+
+    @staticmethod
+    def keys(user_id):
+        return [f'cart:{user_id}', f'cart:{user_id}:items', DIRTY_KEY]
+
+    def _read_many(self, user_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            meta_key, items_key, _ = self.keys(user_id)
+            pipe.hgetall(meta_key)
+            pipe.hgetall(items_key)
+        results = pipe.execute()
+
+        carts = {}
+        for index, user_id in enumerate(user_ids):
+            meta, items = results[2 * index], results[2 * index + 1]
+            if not meta:
+                continue
+            carts[user_id] = {
+                '_id': ObjectId(meta[b'id'].decode()),
+                'user_id': user_id,
+                'items': [
+                    {'product_id': product_id.decode(), 'quantity': int(quantity)}
+                    for product_id, quantity in items.items()
+                ],
+                'created_at': datetime.fromisoformat(meta[b'created_at'].decode()),
+                'updated_at': datetime.fromisoformat(meta[b'updated_at'].decode())
+            }
+        return carts
+
+    def warm(self, cart_data):
+        """Load a Mongo cart document into Redis; False if Redis already holds the cart."""
+        meta_key, items_key, _ = self.keys(cart_data['user_id'])
+        pairs = [value for item in cart_data['items'] for value in (item['product_id'], item['quantity'])]
+        return bool(self._warm(keys=[meta_key, items_key], args=[
+            str(cart_data['_id']),
+            cart_data['created_at'].isoformat(),
+            cart_data['updated_at'].isoformat(),
+            self.ttl,
+            *pairs
+        ]))
+
+    def load(self, db, user_id):
+        """Cart document for user_id, warming Redis from Mongo on a miss."""
+        cart_data = self._read_many([user_id]).get(user_id)
+        if cart_data:
+            return cart_data
+
+        cart_data = db.carts.find_one({'user_id': user_id})
+        if cart_data and not self.warm(cart_data):
+            return self._read_many([user_id]).get(user_id, cart_data)
+        return cart_data
+
+    def _run(self, db, script, user_id, *args):
+        argv = [user_id, datetime.utcnow().isoformat(), self.ttl, *args]
+        result = script(keys=self.keys(user_id), args=argv)
+        if result == -2 and self.load(db, user_id):
+            result = script(keys=self.keys(user_id), args=argv)
+        return result
+
+    def add_item(self, db, user_id, product_id, quantity, max_quantity):
+        if self._run(db, self._add_item, user_id, product_id, quantity, max_quantity) < 1:
+            return None
+        return self.load(db, user_id)
+
+    def set_quantity(self, db, user_id, product_id, quantity):
+        if self._run(db, self._set_quantity, user_id, product_id, quantity) < 1:
+            return None
+        return self.load(db, user_id)
+
+    def remove_item(self, db, user_id, product_id):
+        if self._run(db, self._remove_item, user_id, product_id) < 1:
+            return None
+        return self.load(db, user_id)
+
+    def clear(self, db, user_id):
+        if self._run(db, self._clear, user_id) < 1:
+            return None
+        return self.load(db, user_id)
+
+    def replace_items(self, db, user_id, items, expected_updated_at):
+        """Swap in a whole new item list unless the cart changed since expected_updated_at."""
+        pairs = [value for item in items for value in (item['product_id'], item['quantity'])]
+        if self._run(db, self._replace_items, user_id, expected_updated_at.isoformat(), *pairs) < 1:
+            return None
+        return self.load(db, user_id)
+
+    def remove_quantities(self, user_id, items):
+        """Take (product_id, quantity) lines out of a cart held in Redis, e.g. once ordered.
+
+        Changes made since the lines were read are kept and written back by
+        the next flush. A cart that is not in Redis is left alone.
+        """
+        pairs = [value for product_id, quantity in items for value in (product_id, quantity)]
+        argv = [user_id, datetime.utcnow().isoformat(), self.ttl, *pairs]
+        return self._remove_quantities(keys=self.keys(user_id), args=argv) == 1
+
+    def idle(self, user_ids, cutoff):
+        """The user_ids whose Redis cart has no unflushed changes and is older than cutoff."""
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.sismember(DIRTY_KEY, user_id)
+            pipe.sismember(FLUSHING_KEY, user_id)
+            pipe.hget(self.keys(user_id)[0], 'updated_at')
+        results = pipe.execute()
+
+        idle = []
+        for index, user_id in enumerate(user_ids):
+            dirty, flushing, updated_at = results[3 * index:3 * index + 3]
+            if dirty or flushing or (updated_at and updated_at.decode() >= cutoff.isoformat()):
+                continue
+            idle.append(user_id)
+        return idle
+
+    def evict_idle(self, user_ids, cutoff):
+        """Drop the carts that are still idle (see idle) from Redis."""
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            meta_key, items_key, _ = self.keys(user_id)
+            self._evict_idle(keys=[meta_key, items_key, DIRTY_KEY, FLUSHING_KEY], args=[user_id, cutoff.isoformat()], client=pipe)
+        return sum(pipe.execute())
+
+    def flush(self, db, user_ids=None):
+        """Write dirty carts (or just user_ids) to Mongo; returns the number written."""
+        claimed = user_ids is None
+        if claimed:
+            if not self.client.exists(FLUSHING_KEY):
+                try:
+                    self.client.rename(DIRTY_KEY, FLUSHING_KEY)
+                except ResponseError:
+                    return 0
+            user_ids = [user_id.decode() for user_id in self.client.smembers(FLUSHING_KEY)]
+
+        carts = self._read_many(user_ids)
+        if carts:
+            db.carts.bulk_write([
+                UpdateOne(
+                    {'_id': cart_data['_id']},
+                    {'$set': {
+                        'user_id': cart_data['user_id'],
+                        'items': cart_data['items'],
+                        'created_at': cart_data['created_at'],
+                        'updated_at': cart_data['updated_at']
+                    }},
+                    upsert=True
+                )
+                for cart_data in carts.values()
+            ], ordered=False)
+
+        if claimed:
+            self.client.delete(FLUSHING_KEY)
+        elif user_ids:
+            pipe = self.client.pipeline(transaction=False)
+            for user_id in user_ids:
+                meta_key, _, _ = self.keys(user_id)
+                updated_at = carts[user_id]['updated_at'].isoformat() if user_id in carts else ''
+                self._mark_clean(keys=[meta_key, DIRTY_KEY], args=[user_id, updated_at], client=pipe)
+            pipe.execute()
+        return len(carts)
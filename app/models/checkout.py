@@ -0,0 +1,128 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pymongo.errors import OperationFailure
+from app.models.cart import Cart, cart_store
+from app.models.coupon import Coupon
+from app.models.order import Order, OrderItem
+from app.models.product import Product
+from app.utils.cache import bump_versions, collection_version_key
+
+# Server error code for "transactions are only allowed on a replica set member or mongos"
+ILLEGAL_OPERATION = 20
+
+# Cleared once the server is known not to support transactions
+_transactions_supported = True
+
+class CheckoutError(Exception):
+    pass
+
+class Checkout:
+    """Turn a user's cart into an order, in one transaction where the server supports it."""
+
+    def __init__(self, db, client, user_id):
+        self.db = db
+        self.client = client
+        self.user_id = user_id
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + (time.perf_counter() - start) * 1000
+
+    def server_timing(self):
+        """Timings formatted for a Server-Timing response header."""
+        return ', '.join(f'{name};dur={duration:.1f}' for name, duration in self.timings.items())
+
+    def run(self, shipping_address, coupon_code=None):
+        global _transactions_supported
+
+        with self.stage('cart'):
+            cart = Cart.find_by_user_id(self.user_id, self.db)
+            if cart:
+                # Carts held in the Redis store are written through first
+                cart.persist(self.db)
+            if not cart or not cart.items:
+                raise CheckoutError('Cart is empty')
+            priced_cart = cart.price(self.db)
+            if len(priced_cart.lines) != len(cart.items):
+                raise CheckoutError('Some products are no longer available')
+
+        if coupon_code:
+            with self.stage('coupon_lookup'):
+                coupon = Coupon.find_by_code(coupon_code, self.db)
+                if not coupon:
+                    raise CheckoutError('Invalid or expired coupon')
+                is_valid, error_message = priced_cart.apply_coupon(coupon)
+                if not is_valid:
+                    raise CheckoutError(error_message)
+
+        order = Order(
+            user_id=self.user_id,
+            items=[OrderItem.from_product(product, item.quantity) for item, product, _ in priced_cart.lines],
+            shipping_address=shipping_address,
+            total_amount=priced_cart.total,
+            coupon_code=priced_cart.coupon.code if priced_cart.coupon else None,
+            discount=priced_cart.discount
+        )
+
+        lines = [(item.product_id, item.quantity) for item in order.items]
+        if _transactions_supported:
+            try:
+                with self.client.start_session() as session:
+                    session.with_transaction(lambda session: self._commit(cart, priced_cart, order, lines, session))
+                # Readers must not re-cache pre-commit data under new versions
+                Product.invalidate_many([product_id for product_id, _ in lines])
+                bump_versions(collection_version_key(self.db.orders))
+            except OperationFailure as e:
+                if e.code != ILLEGAL_OPERATION:
+                    raise
+                _transactions_supported = False
+        if not _transactions_supported:
+            self._commit(cart, priced_cart, order, lines)
+
+        if cart_store:
+            # Keeps anything added to the Redis cart since it was persisted
+            cart_store.remove_quantities(self.user_id, lines)
+        return order
+
+    def _commit(self, cart, priced_cart, order, lines, session=None):
+        with self.stage('reserve'):
+            if not Product.reserve_stock(self.db, lines, session):
+                raise CheckoutError('Insufficient stock')
+
+        redeemed = False
+        try:
+            if priced_cart.coupon:
+                with self.stage('redeem'):
+                    if not priced_cart.coupon.redeem(self.db, session):
+                        raise CheckoutError('Coupon usage limit reached')
+                    redeemed = True
+
+            with self.stage('order'):
+                order.save(self.db, session)
+
+            with self.stage('clear_cart'):
+                # A cart edited mid-checkout fails it rather than losing the
+                # new items; Mongo keeps datetimes to the millisecond
+                updated_at = cart.updated_at.replace(microsecond=cart.updated_at.microsecond // 1000 * 1000)
+                result = self.db.carts.update_one(
+                    {'user_id': self.user_id, 'updated_at': updated_at},
+                    {'$set': {'items': [], 'updated_at': datetime.utcnow()}},
+                    session=session
+                )
+                if not result.matched_count:
+                    raise CheckoutError('Cart changed during checkout')
+        except Exception:
+            if not session:
+                # Without a transaction, undo the steps that already happened
+                if getattr(order, 'id', None):
+                    order.delete(self.db)
+                if redeemed:
+                    priced_cart.coupon.release(self.db)
+                Product.release_stock(self.db, lines)
+            raise
@@ -1,8 +1,16 @@
 from datetime import datetime
 from app import mongo
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from app.utils.pagination import keyset_filter
+from app.utils.cache import bump_versions, cached_count, estimated_count, collection_version_key
 
 class Coupon:
+    INDEXES = [
+        IndexModel([('code', ASCENDING)], unique=True, name='code_unique'),
+        IndexModel([('created_at', DESCENDING), ('_id', DESCENDING)], name='created_at_id')
+    ]
+
     def __init__(self, code, discount_type, discount_value, min_purchase=0, 
                  max_discount=None, start_date=None, end_date=None, usage_limit=None):
         self.code = code.upper()
@@ -41,12 +49,13 @@ class Coupon:
         return None
 
     @staticmethod
-    def find_all(db, page=1, per_page=10):
-        skip = (page - 1) * per_page
-        coupons_data = list(db.coupons.find()
-                          .sort('created_at', -1)
-                          .skip(skip)
-                          .limit(per_page))
+    def find_all(db, page=1, per_page=10, after=None):
+        if after:
+            cursor = db.coupons.find(keyset_filter(after, 'created_at', -1))
+        else:
+            cursor = db.coupons.find().skip((page - 1) * per_page)
+
+        coupons_data = list(cursor.sort([('created_at', -1), ('_id', -1)]).limit(per_page))
         
         coupons = []
         for coupon_data in coupons_data:
@@ -70,8 +79,10 @@ class Coupon:
         return coupons
 
     @staticmethod
-    def count(db):
-        return db.coupons.count_documents({})
+    def count(db, estimated=False):
+        if estimated:
+            return estimated_count(db.coupons)
+        return cached_count(db.coupons)
 
     def save(self, db):
         coupon_data = {
@@ -90,6 +101,7 @@ class Coupon:
         }
         result = db.coupons.insert_one(coupon_data)
         self.id = str(result.inserted_id)
+        bump_versions(collection_version_key(db.coupons))
         return self
 
     def update(self, db, **kwargs):
@@ -117,6 +129,7 @@ class Coupon:
 
     def delete(self, db):
         result = db.coupons.delete_one({'_id': ObjectId(self.id)})
+        bump_versions(collection_version_key(db.coupons))
         return result.deleted_count > 0
 
     def validate(self, total_amount):
@@ -143,6 +156,36 @@ class Coupon:
         else:
             return self.discount_value
 
+    def redeem(self, db, session=None):
+        """Count one use, only if the coupon is still active and under its usage limit."""
+        result = db.coupons.update_one(
+            {
+                '_id': ObjectId(self.id),
+                'is_active': True,
+                '$or': [
+                    {'usage_limit': None},
+                    {'$expr': {'$lt': ['$usage_count', '$usage_limit']}}
+                ]
+            },
+            {'$inc': {'usage_count': 1}, '$set': {'updated_at': datetime.utcnow()}},
+            session=session
+        )
+        if result.modified_count:
+            self.usage_count += 1
+            return True
+        return False
+
+    def release(self, db):
+        """Give back a use counted by redeem."""
+        result = db.coupons.update_one(
+            {'_id': ObjectId(self.id), 'usage_count': {'$gt': 0}},
+            {'$inc': {'usage_count': -1}, '$set': {'updated_at': datetime.utcnow()}}
+        )
+        if result.modified_count:
+            self.usage_count -= 1
+            return True
+        return False
+
     def increment_usage(self, db):
         self.usage_count += 1
         return self.update(db, usage_count=self.usage_count)
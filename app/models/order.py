@@ -1,133 +1,437 @@
-from datetime import datetime
+import heapq
+from datetime import datetime, timedelta
 from app import mongo
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
 from app.models.product import Product
+from app.models.stats import Stats
+from app.utils.pagination import keyset_filter, merge_filters
+from app.utils.cache import bump_versions, cached_count, collection_version_key, make_etag
 
 class OrderItem:
-    def __init__(self, product_id, quantity, price):
+    # Product fields copied into each line at checkout
+    PRODUCT_FIELDS = ['id', 'sku', 'name', 'price', 'image_url']
+
+    def __init__(self, product_id, quantity, price, name=None, sku=None, image_url=None):
         self.product_id = product_id
         self.quantity = int(quantity)
         self.price = float(price)
+        self.name = name
+        self.sku = sku
+        self.image_url = image_url
+
+    @staticmethod
+    def from_product(product, quantity):
+        item = OrderItem(product.id, quantity, product.price)
+        item.snapshot(product)
+        return item
+
+    def snapshot(self, product):
+        """Copy descriptive fields from the catalog; the ordered price is kept."""
+        self.name = product.name
+        self.sku = product.sku
+        self.image_url = product.image_url
 
     def to_dict(self):
         return {
             'product_id': self.product_id,
             'quantity': self.quantity,
-            'price': self.price
+            'price': self.price,
+            'name': self.name,
+            'sku': self.sku,
+            'image_url': self.image_url
         }
 
+    def product_dict(self, fields=None):
+        data = {
+            'id': self.product_id,
+            'sku': self.sku,
+            'name': self.name,
+            'price': self.price,
+            'image_url': self.image_url
+        }
+        if fields:
+            return {field: data[field] for field in fields}
+        return data
+
 class Order:
-    def __init__(self, user_id, items, shipping_address, total_amount):
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='user_id_created_at_id'),
+        IndexModel([('status', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='status_created_at_id'),
+        IndexModel([('created_at', DESCENDING), ('_id', DESCENDING)], name='created_at_id'),
+        IndexModel([('cancel_batch', ASCENDING)], sparse=True, name='cancel_batch'),
+        IndexModel([('status_batch', ASCENDING)], sparse=True, name='status_batch'),
+        IndexModel([('status', ASCENDING), ('updated_at', ASCENDING), ('_id', ASCENDING)], name='status_updated_at_id')
+    ]
+
+    STATUS_CHOICES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+
+    # Allowed status changes: pending -> processing -> shipped -> delivered,
+    # with cancellation possible until the order ships
+    TRANSITIONS = {
+        'pending': ['processing', 'cancelled'],
+        'processing': ['shipped', 'cancelled'],
+        'shipped': ['delivered'],
+        'delivered': [],
+        'cancelled': []
+    }
+
+    TERMINAL_STATUSES = ['delivered', 'cancelled']
+
+    EXPORT_FIELDS = ['id', 'user_id', 'status', 'coupon_code', 'discount', 'total_amount', 'created_at', 'updated_at']
+
+    CANCELLABLE_STATUSES = [status for status, targets in TRANSITIONS.items() if 'cancelled' in targets]
+
+    def __init__(self, user_id, items, shipping_address, total_amount, coupon_code=None, discount=0):
         self.user_id = user_id
         self.items = items
         self.shipping_address = shipping_address
         self.total_amount = float(total_amount)
+        self.coupon_code = coupon_code
+        self.discount = float(discount)
         self.status = 'pending'
         self.created_at = datetime.utcnow()
         self.updated_at = datetime.utcnow()
 
+    @staticmethod
+    def from_dict(order_data):
+        order = Order(
+            user_id=order_data['user_id'],
+            items=[OrderItem(**item) for item in order_data['items']],
+            shipping_address=order_data['shipping_address'],
+            total_amount=order_data['total_amount'],
+            coupon_code=order_data.get('coupon_code'),
+            discount=order_data.get('discount', 0)
+        )
+        order.id = str(order_data['_id'])
+        order.status = order_data['status']
+        order.created_at = order_data['created_at']
+        order.updated_at = order_data['updated_at']
+        return order
+
     @staticmethod
     def find_by_id(order_id, db):
         try:
             order_data = db.orders.find_one({'_id': ObjectId(order_id)})
+            if not order_data:
+                order_data = db.orders_archive.find_one({'_id': ObjectId(order_id)})
             if order_data:
-                order = Order(
-                    user_id=order_data['user_id'],
-                    items=[OrderItem(**item) for item in order_data['items']],
-                    shipping_address=order_data['shipping_address'],
-                    total_amount=order_data['total_amount']
-                )
-                order.id = str(order_data['_id'])
-                order.status = order_data['status']
-                order.created_at = order_data['created_at']
-                order.updated_at = order_data['updated_at']
-                return order
+                return Order.from_dict(order_data)
             return None
         except:
             return None
 
     @staticmethod
-    def find_by_user_id(user_id, db, page=1, per_page=10):
-        skip = (page - 1) * per_page
-        orders_data = list(db.orders.find({'user_id': user_id})
-                         .sort('created_at', -1)
-                         .skip(skip)
-                         .limit(per_page))
-        
-        orders = []
-        for order_data in orders_data:
-            order = Order(
-                user_id=order_data['user_id'],
-                items=[OrderItem(**item) for item in order_data['items']],
-                shipping_address=order_data['shipping_address'],
-                total_amount=order_data['total_amount']
+    def find_by_user_id(user_id, db, page=1, per_page=10, after=None):
+        return Order.find_all(db, {'user_id': user_id}, page, per_page, after)
+
+    @staticmethod
+    def find_all(db, query=None, page=1, per_page=10, after=None, include_archived=True):
+        """Newest orders first, merged across the hot and archive collections."""
+        query = dict(query or {})
+        skip = 0
+        if after:
+            query.update(keyset_filter(after, 'created_at', -1))
+        else:
+            skip = (page - 1) * per_page
+
+        sort = [('created_at', -1), ('_id', -1)]
+        if not include_archived:
+            orders_data = list(db.orders.find(query).sort(sort).skip(skip).limit(per_page))
+        else:
+            orders_data = heapq.merge(
+                db.orders.find(query).sort(sort).limit(skip + per_page),
+                db.orders_archive.find(query).sort(sort).limit(skip + per_page),
+                key=lambda order_data: (order_data['created_at'], order_data['_id']),
+                reverse=True
             )
-            order.id = str(order_data['_id'])
-            order.status = order_data['status']
-            order.created_at = order_data['created_at']
-            order.updated_at = order_data['updated_at']
-            orders.append(order)
-        
-        return orders
+            orders_data = list(orders_data)[skip:skip + per_page]
+        return [Order.from_dict(order_data) for order_data in orders_data]
+
+    @staticmethod
+    def count(db, query=None):
+        return cached_count(db.orders, query) + cached_count(db.orders_archive, query)
+
+    @staticmethod
+    def export_cursor(db, start=None, end=None, batch_size=1000):
+        """Server-side cursor over raw orders created in [start, end), oldest first."""
+        query = {}
+        if start or end:
+            query['created_at'] = {}
+            if start:
+                query['created_at']['$gte'] = start
+            if end:
+                query['created_at']['$lt'] = end
+        projection = {field: 1 for field in Order.EXPORT_FIELDS if field != 'id'}
+        projection['items'] = 1
+        return heapq.merge(*[
+            collection.find(query, projection).sort([('created_at', 1), ('_id', 1)]).batch_size(batch_size)
+            for collection in (db.orders, db.orders_archive)
+        ], key=lambda order_data: (order_data['created_at'], order_data['_id']))
 
     @staticmethod
     def count_by_user_id(user_id, db):
-        return db.orders.count_documents({'user_id': user_id})
+        return Order.count(db, {'user_id': user_id})
 
-    def save(self, db):
+    def save(self, db, session=None):
         order_data = {
             'user_id': self.user_id,
             'items': [item.to_dict() for item in self.items],
             'shipping_address': self.shipping_address,
             'total_amount': self.total_amount,
+            'coupon_code': self.coupon_code,
+            'discount': self.discount,
             'status': self.status,
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
-        result = db.orders.insert_one(order_data)
+        result = db.orders.insert_one(order_data, session=session)
         self.id = str(result.inserted_id)
+        Stats.increment(db, {
+            'orders': 1,
+            f'orders_by_status.{self.status}': 1,
+            'revenue': self.total_amount if self.status != 'cancelled' else 0
+        }, session)
+        if not session:
+            # Inside a transaction the caller bumps versions after commit
+            bump_versions(collection_version_key(db.orders))
         return self
 
+    def delete(self, db):
+        result = db.orders.delete_one({'_id': ObjectId(self.id)})
+        if result.deleted_count:
+            Stats.increment(db, {
+                'orders': -1,
+                f'orders_by_status.{self.status}': -1,
+                'revenue': -self.total_amount if self.status != 'cancelled' else 0
+            })
+            bump_versions(collection_version_key(db.orders))
+        return result.deleted_count > 0
+
+    @staticmethod
+    def source_statuses(new_status):
+        """Statuses an order may move to new_status from."""
+        return [status for status, targets in Order.TRANSITIONS.items() if new_status in targets]
+
     def update_status(self, db, new_status):
-        if new_status not in ['pending', 'processing', 'shipped', 'delivered', 'cancelled']:
+        # Cancelling also gives stock back
+        if new_status == 'cancelled':
+            return self.cancel(db)
+
+        sources = Order.source_statuses(new_status)
+        if not sources:
             return False
-        
-        self.status = new_status
-        self.updated_at = datetime.utcnow()
-        
-        result = db.orders.update_one(
-            {'_id': ObjectId(self.id)},
-            {
-                '$set': {
-                    'status': self.status,
-                    'updated_at': self.updated_at
-                }
-            }
+
+        now = datetime.utcnow()
+        previous = db.orders.find_one_and_update(
+            {'_id': ObjectId(self.id), 'status': {'$in': sources}},
+            {'$set': {'status': new_status, 'updated_at': now}},
+            projection={'status': 1}
         )
-        return result.modified_count > 0
+        if not previous:
+            return False
+
+        self.status = new_status
+        self.updated_at = now
+        Stats.order_status_changed(db, previous['status'], new_status, self.total_amount)
+        bump_versions(collection_version_key(db.orders))
+        return True
+
+    @staticmethod
+    def bulk_update_status(db, updates):
+        """Apply (order_id, new_status) changes; returns ({status: [(order_id, user_id)]}, {order_id: error})."""
+        errors = {}
+        targets = {}
+        seen = set()
+        for order_id, new_status in updates:
+            if order_id in seen:
+                continue
+            seen.add(order_id)
+            if new_status not in Order.STATUS_CHOICES or new_status == 'cancelled':
+                errors[order_id] = 'Invalid status'
+                continue
+            try:
+                targets.setdefault(new_status, set()).add(ObjectId(order_id))
+            except:
+                errors[order_id] = 'Order not found'
+
+        batch_id = ObjectId()
+        now = datetime.utcnow()
+        counters = {}
+        for new_status, object_ids in targets.items():
+            for source in Order.source_statuses(new_status):
+                result = db.orders.update_many(
+                    {'_id': {'$in': list(object_ids)}, 'status': source},
+                    {'$set': {'status': new_status, 'updated_at': now, 'status_batch': batch_id}}
+                )
+                if result.modified_count:
+                    counters[f'orders_by_status.{source}'] = counters.get(f'orders_by_status.{source}', 0) - result.modified_count
+                    counters[f'orders_by_status.{new_status}'] = counters.get(f'orders_by_status.{new_status}', 0) + result.modified_count
+
+        updated = {}
+        updated_ids = set()
+        for order_data in db.orders.find({'status_batch': batch_id}, {'status': 1, 'user_id': 1}):
+            updated.setdefault(order_data['status'], []).append((str(order_data['_id']), order_data['user_id']))
+            updated_ids.add(order_data['_id'])
+        if updated_ids:
+            db.orders.update_many({'status_batch': batch_id}, {'$unset': {'status_batch': ''}})
+            Stats.increment(db, counters)
+            bump_versions(collection_version_key(db.orders))
+
+        # Explain the rest with one lookup of their current status
+        rejected = [object_id for object_ids in targets.values() for object_id in object_ids if object_id not in updated_ids]
+        current = {
+            order_data['_id']: order_data['status']
+            for order_data in db.orders.find({'_id': {'$in': rejected}}, {'status': 1})
+        } if rejected else {}
+        for object_id in rejected:
+            if object_id in current:
+                errors[str(object_id)] = f'Cannot change status from {current[object_id]}'
+            else:
+                errors[str(object_id)] = 'Order not found'
+
+        return updated, errors
 
     def cancel(self, db):
-        if self.status not in ['pending', 'processing']:
+        # Flip the status first so stock is only ever restored once per order
+        now = datetime.utcnow()
+        previous = db.orders.find_one_and_update(
+            {'_id': ObjectId(self.id), 'status': {'$in': Order.CANCELLABLE_STATUSES}},
+            {'$set': {'status': 'cancelled', 'updated_at': now}},
+            projection={'status': 1}
+        )
+        if not previous:
             return False
-        
-        # Restore product stock
-        for item in self.items:
-            product = Product.find_by_id(item.product_id, db)
-            if product:
-                product.update_stock(db, item.quantity)
-        
-        return self.update_status(db, 'cancelled')
 
-    def to_dict(self, db):
+        self.status = 'cancelled'
+        self.updated_at = now
+        Stats.order_status_changed(db, previous['status'], 'cancelled', self.total_amount)
+        Product.release_stock(db, [(item.product_id, item.quantity) for item in self.items])
+        bump_versions(collection_version_key(db.orders))
+        return True
+
+    @staticmethod
+    def cancel_many(db, order_ids):
+        """Cancel the cancellable orders in order_ids and restore their stock; returns the number cancelled."""
+        object_ids = [ObjectId(order_id) for order_id in order_ids if ObjectId.is_valid(order_id)]
+        if not object_ids:
+            return 0
+
+        batch_id = ObjectId()
+        now = datetime.utcnow()
+        counters = {}
+        cancelled = 0
+        # One update per source status keeps the dashboard counters exact
+        for status in Order.CANCELLABLE_STATUSES:
+            result = db.orders.update_many(
+                {'_id': {'$in': object_ids}, 'status': status},
+                {'$set': {'status': 'cancelled', 'updated_at': now, 'cancel_batch': batch_id}}
+            )
+            counters[f'orders_by_status.{status}'] = -result.modified_count
+            cancelled += result.modified_count
+        if not cancelled:
+            return 0
+
+        lines = []
+        revenue = 0
+        for order_data in db.orders.find({'cancel_batch': batch_id}, {'items.product_id': 1, 'items.quantity': 1, 'total_amount': 1}):
+            lines.extend((item['product_id'], item['quantity']) for item in order_data['items'])
+            revenue += order_data['total_amount']
+        Product.release_stock(db, lines)
+        db.orders.update_many({'cancel_batch': batch_id}, {'$unset': {'cancel_batch': ''}})
+
+        counters.update({'orders_by_status.cancelled': cancelled, 'revenue': -revenue})
+        Stats.increment(db, counters)
+        bump_versions(collection_version_key(db.orders))
+        return cancelled
+
+    @staticmethod
+    def archive(db, days, batch_size=1000):
+        """Move orders that reached a terminal status over `days` days ago to orders_archive; returns the number moved."""
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        query = {'status': {'$in': Order.TERMINAL_STATUSES}, 'updated_at': {'$lt': cutoff}}
+        moved = 0
+        last = None
+        while True:
+            batch_query = query
+            if last:
+                batch_query = merge_filters(query, {'$or': [
+                    {'updated_at': {'$gt': last['updated_at']}},
+                    {'updated_at': last['updated_at'], '_id': {'$gt': last['_id']}}
+                ]})
+            batch = list(db.orders.find(batch_query).sort([('updated_at', ASCENDING), ('_id', ASCENDING)]).limit(batch_size))
+            if not batch:
+                break
+            last = batch[-1]
+
+            try:
+                db.orders_archive.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Only copies left by an interrupted run are acceptable
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+            result = db.orders.delete_many(dict(query, _id={'$in': [order_data['_id'] for order_data in batch]}))
+            moved += result.deleted_count
+
+            if len(batch) < batch_size:
+                break
+
+        if moved:
+            bump_versions(collection_version_key(db.orders), collection_version_key(db.orders_archive))
+        return moved
+
+    @staticmethod
+    def backfill_snapshots(db, batch_size=500):
+        """Add product snapshots to order lines written before they existed; returns orders updated."""
+        updated = 0
+        last_id = None
+        while True:
+            query = {'items': {'$elemMatch': {'name': {'$exists': False}}}}
+            if last_id:
+                query['_id'] = {'$gt': last_id}
+            batch = list(db.orders.find(query, {'items': 1}).sort('_id', 1).limit(batch_size))
+            if not batch:
+                break
+            last_id = batch[-1]['_id']
+
+            product_ids = {item['product_id'] for order_data in batch for item in order_data['items']}
+            products = Product.find_many(list(product_ids), db)
+
+            requests = []
+            for order_data in batch:
+                items = [OrderItem(**item) for item in order_data['items']]
+                for item in items:
+                    if item.name is None and item.product_id in products:
+                        item.snapshot(products[item.product_id])
+                requests.append(UpdateOne(
+                    {'_id': order_data['_id']},
+                    {'$set': {'items': [item.to_dict() for item in items]}}
+                ))
+            updated += db.orders.bulk_write(requests, ordered=False).modified_count
+
+            if len(batch) < batch_size:
+                break
+        return updated
+
+    def etag(self, fields=None):
+        return make_etag(self.id, self.updated_at, self.status, fields)
+
+    def to_dict(self, db=None, fields=None):
+        # Lines carry a product snapshot, so no product lookups are needed;
+        # only lines written before snapshots existed fall back to the catalog
+        missing = [item.product_id for item in self.items if item.name is None]
+        products = Product.find_many(missing, db) if missing and db is not None else {}
+
         items = []
         for item in self.items:
-            product = Product.find_by_id(item.product_id, db)
-            if product:
-                items.append({
-                    'product': product.to_dict(),
-                    'quantity': item.quantity,
-                    'price': item.price
-                })
+            if item.product_id in products:
+                item.snapshot(products[item.product_id])
+            items.append({
+                'product': item.product_dict(fields),
+                'quantity': item.quantity,
+                'price': item.price
+            })
 
         return {
             'id': self.id,
@@ -135,6 +439,8 @@ class Order:
             'items': items,
             'shipping_address': self.shipping_address,
             'total_amount': self.total_amount,
+            'coupon_code': self.coupon_code,
+            'discount': self.discount,
             'status': self.status,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
@@ -1,68 +1,178 @@
 from datetime import datetime
 from app import mongo
+from app.utils.cache import LocalCache, get_version, get_versions, bump_versions, cached_count, estimated_count
+from app.utils.pagination import keyset_filter, merge_filters
+from app.utils.serializers import RawJSON, encode
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from app.models.stats import Stats
+from config import Config
+
+# Bumped on every product write; also the key cached_count uses for products.
+CATALOG_VERSION_KEY = 'products:version'
+# Bumped only when products are added or removed, i.e. list membership changes.
+LIST_VERSION_KEY = 'products:list:version'
+
+# Process-local L1 cache of raw product documents, validated against
+# version counters in Redis so admin edits are never served stale.
+_product_cache = LocalCache(maxsize=Config.PRODUCT_CACHE_SIZE, ttl=Config.PRODUCT_CACHE_TTL)
+
+# Serialized product JSON keyed by (id, updated_at); any write changes
+# updated_at, so entries never need explicit invalidation.
+_fragment_cache = LocalCache(maxsize=Config.PRODUCT_CACHE_SIZE, ttl=Config.CACHE_DEFAULT_TIMEOUT)
+
+_text_index_ready = False
+
+# Reservation ids kept on each product by reserve_stock
+RESERVATION_TAGS = 20
+
+TEXT_INDEX = IndexModel(
+    [('name', TEXT), ('description', TEXT)],
+    weights={'name': 10, 'description': 2},
+    name='products_text'
+)
 
 class Product:
-    def __init__(self, name, description, price, category, stock, image_url=None):
+    INDEXES = [
+        IndexModel([('category', ASCENDING), ('_id', ASCENDING)], name='category_id'),
+        IndexModel([('sku', ASCENDING)], unique=True, partialFilterExpression={'sku': {'$gt': ''}}, name='sku_unique'),
+        IndexModel([('stock', DESCENDING)], name='stock'),
+        TEXT_INDEX
+    ]
+
+    FIELDS = ['id', 'sku', 'name', 'description', 'price', 'category', 'stock', 'image_url', 'created_at', 'updated_at']
+
+    def __init__(self, name, description, price, category, stock, image_url=None, sku=None):
         self.name = name
         self.description = description
         self.price = float(price)
         self.category = category
         self.stock = int(stock)
         self.image_url = image_url
+        self.sku = sku
         self.created_at = datetime.utcnow()
         self.updated_at = datetime.utcnow()
     
     @staticmethod
     def from_dict(data):
+        # Documents loaded with a projection may lack any non-_id field
         product = Product(
-            name=data['name'],
-            description=data['description'],
-            price=data['price'],
-            category=data['category'],
-            stock=data['stock'],
-            image_url=data.get('image_url')
+            name=data.get('name'),
+            description=data.get('description'),
+            price=data.get('price', 0),
+            category=data.get('category'),
+            stock=data.get('stock', 0),
+            image_url=data.get('image_url'),
+            sku=data.get('sku')
         )
-        product.created_at = data['created_at']
-        product.updated_at = data['updated_at']
+        product.created_at = data.get('created_at')
+        product.updated_at = data.get('updated_at')
         if '_id' in data:
             product.id = str(data['_id'])
         return product
     
-    def to_dict(self):
-        return {
+    def to_dict(self, fields=None):
+        data = {
             'id': self.id,
+            'sku': self.sku,
             'name': self.name,
             'description': self.description,
             'price': self.price,
             'category': self.category,
             'stock': self.stock,
             'image_url': self.image_url,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
+        if fields:
+            return {field: data[field] for field in fields}
+        return data
+
+    def to_json(self):
+        """Pre-serialized to_dict() as a RawJSON fragment for list responses."""
+        key = (self.id, self.updated_at)
+        fragment = _fragment_cache.get(key)
+        if fragment is None:
+            fragment = RawJSON(encode(self.to_dict()))
+            _fragment_cache.set(key, fragment)
+        return fragment
+
+    @staticmethod
+    def projection(fields):
+        """Mongo projection for a sparse fieldset; None means the whole document."""
+        if not fields:
+            return None
+        return {field: 1 for field in fields if field != 'id'} or {'_id': 1}
     
+    @staticmethod
+    def version_key(product_id):
+        return f'product:{product_id}:version'
+
+    @staticmethod
+    def category_version_key(category):
+        return f'category:{category}:version'
+
     @staticmethod
     def find_by_id(product_id, db):
         try:
+            version = get_version(Product.version_key(product_id))
+            if version is not None:
+                product_data = _product_cache.get(str(product_id), version)
+                if product_data:
+                    return Product.from_dict(product_data)
+
             product_data = db.products.find_one({'_id': ObjectId(product_id)})
             if product_data:
-                product = Product(
-                    name=product_data['name'],
-                    description=product_data['description'],
-                    price=product_data['price'],
-                    category=product_data['category'],
-                    stock=product_data['stock'],
-                    image_url=product_data.get('image_url')
-                )
-                product.id = str(product_data['_id'])
-                product.created_at = product_data['created_at']
-                product.updated_at = product_data['updated_at']
-                return product
+                if version is not None:
+                    _product_cache.set(str(product_id), product_data, version)
+                return Product.from_dict(product_data)
             return None
         except:
             return None
-    
+
+    @staticmethod
+    def find_many(product_ids, db, fields=None):
+        """Load several products with a single $in query, keyed by id.
+
+        Products held in the local cache are served from memory; only the
+        misses are fetched from Mongo, projected to ``fields`` if given.
+        Projected documents are partial and are not cached.
+        """
+        product_ids = list({str(product_id) for product_id in product_ids})
+        if not product_ids:
+            return {}
+
+        products = {}
+        versions = get_versions([Product.version_key(product_id) for product_id in product_ids])
+        if versions is None:
+            missing = {product_id: None for product_id in product_ids}
+        else:
+            missing = {}
+            for product_id, version in zip(product_ids, versions):
+                product_data = _product_cache.get(product_id, version)
+                if product_data:
+                    products[product_id] = Product.from_dict(product_data)
+                else:
+                    missing[product_id] = version
+
+        object_ids = []
+        for product_id in missing:
+            try:
+                object_ids.append(ObjectId(product_id))
+            except:
+                continue
+
+        if object_ids:
+            cursor = db.products.find({'_id': {'$in': object_ids}}, Product.projection(fields))
+            for product_data in cursor:
+                product_id = str(product_data['_id'])
+                if missing[product_id] is not None and not fields:
+                    _product_cache.set(product_id, product_data, missing[product_id])
+                products[product_id] = Product.from_dict(product_data)
+
+        return products
+
     @staticmethod
     def find_by_category(db, category, page=1, per_page=10):
         skip = (page - 1) * per_page
@@ -70,37 +180,72 @@ class Product:
         return [Product.from_dict(product) for product in cursor]
     
     @staticmethod
-    def find_all(db, category=None, page=1, per_page=10):
+    def find_all(db, category=None, page=1, per_page=10, after=None, fields=None):
+        """List products ordered by _id.
+
+        When an ``after`` cursor is given the page is resolved with an _id
+        range query; page/per_page skipping is kept for compatibility.
+        """
         query = {}
         if category:
             query['category'] = category
-        
+
+        cache_key = ('find_all', category, after or page, per_page, tuple(fields or ()))
+        version = get_version(CATALOG_VERSION_KEY)
+        products_data = _product_cache.get(cache_key, version) if version is not None else None
+
+        if products_data is None:
+            if after:
+                cursor = db.products.find(merge_filters(query, keyset_filter(after)), Product.projection(fields))
+            else:
+                cursor = db.products.find(query, Product.projection(fields)).skip((page - 1) * per_page)
+            products_data = list(cursor.sort('_id', 1).limit(per_page))
+            if version is not None:
+                _product_cache.set(cache_key, products_data, version)
+
+        return [Product.from_dict(product_data) for product_data in products_data]
+
+    @staticmethod
+    def ensure_text_index(db):
+        """Create the weighted text index backing Product.search once per process."""
+        global _text_index_ready
+        if not _text_index_ready:
+            db.products.create_indexes([TEXT_INDEX])
+            _text_index_ready = True
+
+    @staticmethod
+    def search(db, text, category=None, page=1, per_page=10, fields=None):
+        """Full-text search ranked by relevance.
+
+        Mongo's text index handles tokenization, stop words and stemming, so
+        the cost depends on the matching postings rather than catalog size.
+        """
+        Product.ensure_text_index(db)
+        query = {'$text': {'$search': text}}
+        if category:
+            query['category'] = category
+
+        projection = Product.projection(fields) or {}
+        projection['score'] = {'$meta': 'textScore'}
+
         skip = (page - 1) * per_page
-        products_data = list(db.products.find(query).skip(skip).limit(per_page))
-        
-        products = []
-        for product_data in products_data:
-            product = Product(
-                name=product_data['name'],
-                description=product_data['description'],
-                price=product_data['price'],
-                category=product_data['category'],
-                stock=product_data['stock'],
-                image_url=product_data.get('image_url')
-            )
-            product.id = str(product_data['_id'])
-            product.created_at = product_data['created_at']
-            product.updated_at = product_data['updated_at']
-            products.append(product)
-        
-        return products
-    
+        cursor = (db.products.find(query, projection)
+                  .sort([('score', {'$meta': 'textScore'})])
+                  .skip(skip)
+                  .limit(per_page))
+        return [Product.from_dict(product_data) for product_data in cursor]
+
     @staticmethod
-    def count(db, category=None):
+    def count(db, category=None, search=None, estimated=False):
         query = {}
         if category:
             query['category'] = category
-        return db.products.count_documents(query)
+        if search:
+            Product.ensure_text_index(db)
+            query['$text'] = {'$search': search}
+        if estimated:
+            return estimated_count(db.products, query)
+        return cached_count(db.products, query)
     
     def save(self, db):
         product_data = {
@@ -110,14 +255,72 @@ class Product:
             'category': self.category,
             'stock': self.stock,
             'image_url': self.image_url,
+            'sku': self.sku,
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
         result = db.products.insert_one(product_data)
         self.id = str(result.inserted_id)
+        Stats.increment(db, {'products': 1})
+        Product.invalidate_many([], categories=[self.category], membership=True)
         return self
     
+    @staticmethod
+    def bulk_upsert(db, rows):
+        """Insert or update a chunk of validated rows keyed by SKU.
+
+        Uses one unordered bulk_write, so a bad row does not stop the rest
+        of the chunk. Returns the BulkWriteResult.
+        """
+        skus = [row['sku'] for row in rows]
+        existing = list(db.products.find({'sku': {'$in': skus}}, {'_id': 1, 'category': 1}))
+
+        now = datetime.utcnow()
+        operations = []
+        for row in rows:
+            operations.append(UpdateOne(
+                {'sku': row['sku']},
+                {
+                    '$set': {
+                        'name': row['name'],
+                        'description': row['description'],
+                        'price': float(row['price']),
+                        'category': row['category'],
+                        'stock': int(row['stock']),
+                        'image_url': row.get('image_url') or None,
+                        'updated_at': now
+                    },
+                    '$setOnInsert': {'created_at': now}
+                },
+                upsert=True
+            ))
+
+        try:
+            result = db.products.bulk_write(operations, ordered=False)
+            Stats.increment(db, {'products': result.upserted_count})
+            return result
+        except BulkWriteError as e:
+            Stats.increment(db, {'products': e.details['nUpserted']})
+            raise
+        finally:
+            # Existing products may have changed or moved category; new ones
+            # change list membership
+            Product.invalidate_many(
+                [product_data['_id'] for product_data in existing],
+                categories={row['category'] for row in rows} | {product_data.get('category') for product_data in existing},
+                membership=len(existing) < len(rows)
+            )
+
+    @staticmethod
+    def export_cursor(db, category=None, batch_size=1000):
+        """Server-side cursor over raw product documents, for streaming exports."""
+        query = {}
+        if category:
+            query['category'] = category
+        return db.products.find(query).sort('_id', 1).batch_size(batch_size)
+
     def update(self, db, **kwargs):
+        previous_category = self.category
         update_data = {}
         for key, value in kwargs.items():
             if hasattr(self, key):
@@ -133,16 +336,130 @@ class Product:
             )
             for key, value in update_data.items():
                 setattr(self, key, value)
+            categories = {previous_category, self.category} if self.category != previous_category else ()
+            Product.invalidate_many([self.id], categories=categories)
             return True
         return False
     
     def delete(self, db):
         result = db.products.delete_one({'_id': ObjectId(self.id)})
+        Stats.increment(db, {'products': -result.deleted_count})
+        Product.invalidate_many([self.id], categories=[self.category], membership=True)
         return result.deleted_count > 0
+
+    def invalidate_cache(self):
+        Product.invalidate_many([self.id])
+
+    @staticmethod
+    def invalidate_many(product_ids, categories=(), membership=False):
+        """Bump the version counters that cached products and responses are tagged with.
+
+        Per-product keys cover anything that shows a product's fields,
+        category keys cover filtered listings and LIST_VERSION_KEY covers
+        unfiltered listings whose membership changed.
+        """
+        for product_id in product_ids:
+            _product_cache.delete(str(product_id))
+        keys = [CATALOG_VERSION_KEY]
+        keys += [Product.version_key(product_id) for product_id in product_ids]
+        keys += [Product.category_version_key(category) for category in categories if category]
+        if membership:
+            keys.append(LIST_VERSION_KEY)
+        bump_versions(*keys)
     
     def update_stock(self, db, quantity):
-        if self.stock + quantity >= 0:
-            self.stock += quantity
-            self.update(db, stock=self.stock)
+        """Add quantity to stock (negative to take stock) in one conditional $inc.
+
+        The stock guard is part of the update filter, so concurrent callers
+        can never drive stock below zero.
+        """
+        quantity = int(quantity)
+        product_data = db.products.find_one_and_update(
+            {'_id': ObjectId(self.id), 'stock': {'$gte': -quantity}},
+            {'$inc': {'stock': quantity}, '$set': {'updated_at': datetime.utcnow()}},
+            projection={'stock': 1, 'updated_at': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not product_data:
+            return False
+
+        self.stock = product_data['stock']
+        self.updated_at = product_data['updated_at']
+        self.invalidate_cache()
+        return True
+
+    @staticmethod
+    def release_stock(db, items, session=None):
+        """Give back stock for every (product_id, quantity) line in one bulk_write."""
+        quantities = {}
+        for product_id, quantity in items:
+            quantities[str(product_id)] = quantities.get(str(product_id), 0) + int(quantity)
+        if not quantities:
+            return 0
+
+        now = datetime.utcnow()
+        result = db.products.bulk_write([
+            UpdateOne({'_id': ObjectId(product_id)}, {'$inc': {'stock': quantity}, '$set': {'updated_at': now}})
+            for product_id, quantity in quantities.items()
+        ], ordered=False, session=session)
+        Product.invalidate_many(list(quantities))
+        return result.modified_count
+
+    @staticmethod
+    def reserve_stock(db, items, session=None):
+        """Take stock for every (product_id, quantity) line in one bulk_write, or for none of them.
+
+        Inside a transaction (session given) caches are left alone; the
+        caller invalidates them once the transaction has committed.
+        """
+        quantities = {}
+        for product_id, quantity in items:
+            quantities[str(product_id)] = quantities.get(str(product_id), 0) + int(quantity)
+        if not quantities:
+            return True
+        if any(quantity <= 0 for quantity in quantities.values()):
+            return False
+        try:
+            object_ids = {product_id: ObjectId(product_id) for product_id in quantities}
+        except:
+            return False
+
+        # Each decrement tags the product with this reservation, so after a
+        # partial failure the lines that landed can be given back exactly.
+        # Only the latest tags are kept; the list never needs cleaning up.
+        reservation_id = ObjectId()
+        now = datetime.utcnow()
+        result = db.products.bulk_write([
+            UpdateOne(
+                {'_id': object_ids[product_id], 'stock': {'$gte': quantity}},
+                {
+                    '$inc': {'stock': -quantity},
+                    '$set': {'updated_at': now},
+                    '$push': {'reservations': {'$each': [reservation_id], '$slice': -RESERVATION_TAGS}}
+                }
+            )
+            for product_id, quantity in quantities.items()
+        ], ordered=False, session=session)
+
+        if result.matched_count == len(quantities):
+            if not session:
+                Product.invalidate_many(list(quantities))
             return True
-        return False 
\ No newline at end of file
+        if session:
+            # Aborting the transaction undoes every line
+            return False
+
+        if result.matched_count:
+            db.products.bulk_write([
+                UpdateOne(
+                    {'_id': object_ids[product_id], 'reservations': reservation_id},
+                    {
+                        '$inc': {'stock': quantity},
+                        '$pull': {'reservations': reservation_id},
+                        '$set': {'updated_at': datetime.utcnow()}
+                    }
+                )
+                for product_id, quantity in quantities.items()
+            ], ordered=False)
+            Product.invalidate_many(list(quantities))
+        return False
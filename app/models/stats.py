@@ -0,0 +1,120 @@
+from contextlib import nullcontext
+from datetime import datetime
+from pymongo.errors import ConfigurationError, OperationFailure
+
+ORDER_STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+
+# Snapshot reads need a replica set on MongoDB 5.0+; cleared on first failure
+_snapshot_reads_supported = True
+
+class Stats:
+    """Dashboard counters kept in one document, updated with $inc and corrected by rebuild()."""
+
+    DOCUMENT_ID = 'dashboard'
+
+    @staticmethod
+    def increment(db, counters, session=None):
+        counters = {field: value for field, value in counters.items() if value}
+        if not counters:
+            return
+        # No upsert: until the first rebuild seeds the document there is
+        # nothing to keep in step, and get() will rebuild it from scratch
+        db.stats.update_one(
+            {'_id': Stats.DOCUMENT_ID},
+            {'$inc': counters, '$set': {'updated_at': datetime.utcnow()}},
+            session=session
+        )
+
+    @staticmethod
+    def order_status_changed(db, old_status, new_status, total_amount, session=None):
+        if old_status == new_status:
+            return
+        revenue = 0
+        if new_status == 'cancelled':
+            revenue = -total_amount
+        elif old_status == 'cancelled':
+            revenue = total_amount
+        Stats.increment(db, {
+            f'orders_by_status.{old_status}': -1,
+            f'orders_by_status.{new_status}': 1,
+            'revenue': revenue
+        }, session)
+
+    @staticmethod
+    def get(db):
+        stats = db.stats.find_one({'_id': Stats.DOCUMENT_ID})
+        if not stats:
+            stats = Stats.rebuild(db)
+        return stats
+
+    @staticmethod
+    def rebuild(db):
+        """Recompute the counters and apply the difference, keeping increments made meanwhile."""
+        global _snapshot_reads_supported
+
+        if _snapshot_reads_supported:
+            try:
+                with db.client.start_session(snapshot=True) as session:
+                    current, stats = Stats._read(db, session)
+            except (ConfigurationError, OperationFailure):
+                _snapshot_reads_supported = False
+        if not _snapshot_reads_supported:
+            current, stats = Stats._read(db, None)
+
+        now = datetime.utcnow()
+        if current is None:
+            # Nothing has been incremented yet; a concurrent rebuild may seed it first
+            db.stats.update_one(
+                {'_id': Stats.DOCUMENT_ID},
+                {'$setOnInsert': dict(stats, updated_at=now)},
+                upsert=True
+            )
+        else:
+            # $inc by the drift rather than replacing, so increments made
+            # after the snapshot are not overwritten
+            target, seen = Stats._flatten(stats), Stats._flatten(current)
+            drift = {field: value - seen.get(field, 0) for field, value in target.items() if value != seen.get(field, 0)}
+            update = {'$set': {'updated_at': now}}
+            if drift:
+                update['$inc'] = drift
+            db.stats.update_one({'_id': Stats.DOCUMENT_ID}, update)
+        return db.stats.find_one({'_id': Stats.DOCUMENT_ID})
+
+    @staticmethod
+    def _read(db, session):
+        """The stats document and the counters recomputed from the source collections."""
+        current = db.stats.find_one({'_id': Stats.DOCUMENT_ID}, session=session)
+        orders_by_status = {status: 0 for status in ORDER_STATUSES}
+        revenue = 0
+        # Archived orders still count towards the totals
+        for collection in (db.orders, db.orders_archive):
+            facets = next(collection.aggregate([
+                {'$facet': {
+                    'by_status': [
+                        {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+                    ],
+                    'revenue': [
+                        {'$match': {'status': {'$ne': 'cancelled'}}},
+                        {'$group': {'_id': None, 'total': {'$sum': '$total_amount'}}}
+                    ]
+                }}
+            ], session=session))
+            for row in facets['by_status']:
+                orders_by_status[row['_id']] = orders_by_status.get(row['_id'], 0) + row['count']
+            if facets['revenue']:
+                revenue += facets['revenue'][0]['total']
+
+        return current, {
+            'users': db.users.count_documents({}, session=session),
+            'products': db.products.count_documents({}, session=session),
+            'orders': sum(orders_by_status.values()),
+            'orders_by_status': orders_by_status,
+            'revenue': revenue
+        }
+
+    @staticmethod
+    def _flatten(stats):
+        counters = {field: stats.get(field, 0) for field in ('users', 'products', 'orders', 'revenue')}
+        for status, count in stats.get('orders_by_status', {}).items():
+            counters[f'orders_by_status.{status}'] = count
+        return counters
@@ -2,8 +2,16 @@ from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import mongo
 from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from app.utils.pagination import keyset_filter
+from app.utils.cache import bump_versions, cached_count, estimated_count, collection_version_key
+from app.models.stats import Stats
 
 class User:
+    INDEXES = [
+        IndexModel([('email', ASCENDING)], unique=True, name='email_unique')
+    ]
+
     def __init__(self, email, password, name, role='customer'):
         self.email = email
         self.password = generate_password_hash(password)
@@ -75,6 +83,20 @@ class User:
         except:
             return None
     
+    @staticmethod
+    def find_all(db, page=1, per_page=10, after=None):
+        if after:
+            cursor = db.users.find(keyset_filter(after))
+        else:
+            cursor = db.users.find().skip((page - 1) * per_page)
+        return [User.from_dict(user_data) for user_data in cursor.sort('_id', 1).limit(per_page)]
+
+    @staticmethod
+    def count(db, estimated=False):
+        if estimated:
+            return estimated_count(db.users)
+        return cached_count(db.users)
+    
     def save(self, db):
         user_data = {
             'email': self.email,
@@ -86,6 +108,8 @@ class User:
         }
         result = db.users.insert_one(user_data)
         self.id = str(result.inserted_id)
+        Stats.increment(db, {'users': 1})
+        bump_versions(collection_version_key(db.users))
         return self
     
     def update(self, db, **kwargs):
@@ -109,6 +133,8 @@ class User:
     
     def delete(self, db):
         result = db.users.delete_one({'_id': ObjectId(self.id)})
+        Stats.increment(db, {'users': -result.deleted_count})
+        bump_versions(collection_version_key(db.users))
         return result.deleted_count > 0
     
     def is_admin(self):
@@ -1,17 +1,31 @@
-from flask import Blueprint, request, jsonify
+import csv
+import io
+import json
+from datetime import datetime
+from bson import ObjectId
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from app.models.user import User
 from app.models.order import Order
 from app.models.product import Product
+from app.models.stats import Stats
 from app.utils.error_handlers import handle_validation_error, handle_unauthorized_error, handle_not_found_error
+from app.utils.validators import validate_cursor
+from app.utils.pagination import next_cursor
+from app.utils.idempotency import idempotent
 from app import mongo
-from app.tasks import update_order_status, cleanup_expired_coupons
+from app.tasks import update_order_status, cleanup_expired_coupons, bulk_cancel_orders, send_status_update_emails
+from app.websocket import broadcast_order_updates
 
 admin_bp = Blueprint('admin', __name__)
 
+MAX_BULK_STATUS_UPDATES = 5000
+
+ORDER_ITEM_EXPORT_FIELDS = ['product_id', 'sku', 'name', 'quantity', 'price']
+
 def admin_required():
     user_id = get_jwt_identity()
-    user = User.get_by_id(user_id)
+    user = User.find_by_id(user_id, mongo.db)
     
     if not user or not user.is_admin():
         return handle_unauthorized_error('Admin access required')
@@ -27,20 +41,23 @@ def get_users():
     
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 10))
+    after = request.args.get('after')
+    
+    if after and not validate_cursor(after):
+        return handle_validation_error('Invalid cursor')
     
     # Get users with pagination
-    skip = (page - 1) * per_page
-    cursor = mongo.db.users.find().skip(skip).limit(per_page)
-    users = [User.from_dict(user) for user in cursor]
+    users = User.find_all(mongo.db, page, per_page, after)
     
     # Get total count
-    total = mongo.db.users.count_documents({})
+    total = User.count(mongo.db, request.args.get('total') == 'estimated')
     
     return jsonify({
         'users': [user.to_dict() for user in users],
         'total': total,
         'page': page,
-        'per_page': per_page
+        'per_page': per_page,
+        'next_cursor': next_cursor(users, per_page)
     }), 200
 
 @admin_bp.route('/users/<user_id>', methods=['GET'])
@@ -134,21 +151,83 @@ def get_all_orders():
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 10))
     status = request.args.get('status')
+    after = request.args.get('after')
+    
+    if after and not validate_cursor(after):
+        return handle_validation_error('Invalid cursor')
     
     query = {}
     if status:
         query['status'] = status
-        
-    orders = Order.find(query, page, per_page)
-    total = Order.count(query)
+    
+    # Order lines carry product snapshots, so listing needs no product queries
+    orders = Order.find_all(mongo.db, query, page, per_page, after)
+    total = Order.count(mongo.db, query)
     
     return jsonify({
-        'orders': [order.to_dict() for order in orders],
+        'orders': [order.to_dict(mongo.db) for order in orders],
         'total': total,
         'page': page,
-        'per_page': per_page
+        'per_page': per_page,
+        'next_cursor': next_cursor(orders, per_page, 'created_at')
     })
 
+@admin_bp.route('/orders/export', methods=['GET'])
+@jwt_required()
+def export_orders():
+    error = admin_required()
+    if error:
+        return error
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ['ndjson', 'csv']:
+        return handle_validation_error('Invalid format')
+    
+    try:
+        start = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+        end = datetime.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return handle_validation_error('Invalid date range')
+    
+    cursor = Order.export_cursor(mongo.db, start, end)
+    
+    def export_row(order_data):
+        row = {field: order_data.get(field) for field in Order.EXPORT_FIELDS if field != 'id'}
+        row['id'] = str(order_data['_id'])
+        row['created_at'] = order_data['created_at'].isoformat()
+        row['updated_at'] = order_data['updated_at'].isoformat()
+        return row
+    
+    def generate_ndjson():
+        for order_data in cursor:
+            row = export_row(order_data)
+            row['items'] = order_data['items']
+            yield json.dumps(row) + '\n'
+    
+    def generate_csv():
+        # One row per order line, with the order columns repeated
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=Order.EXPORT_FIELDS + ORDER_ITEM_EXPORT_FIELDS)
+        writer.writeheader()
+        for order_data in cursor:
+            row = export_row(order_data)
+            for item in order_data['items']:
+                writer.writerow(dict(row, **{field: item.get(field) for field in ORDER_ITEM_EXPORT_FIELDS}))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if export_format == 'csv':
+        body, mimetype = generate_csv(), 'text/csv'
+    else:
+        body, mimetype = generate_ndjson(), 'application/x-ndjson'
+    
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=orders.{export_format}'}
+    )
+
 @admin_bp.route('/orders/<order_id>', methods=['PUT'])
 @jwt_required()
 def update_order_status(order_id):
@@ -156,7 +235,7 @@ def update_order_status(order_id):
     if error:
         return error
         
-    order = Order.get_by_id(order_id)
+    order = Order.find_by_id(order_id, mongo.db)
     if not order:
         return handle_not_found_error('Order not found')
         
@@ -165,11 +244,91 @@ def update_order_status(order_id):
     
     if not new_status or new_status not in Order.STATUS_CHOICES:
         return handle_validation_error('Invalid status')
-        
-    order.status = new_status
-    order.save()
     
-    return jsonify(order.to_dict())
+    # The state machine check is part of the update filter
+    if not order.update_status(mongo.db, new_status):
+        return handle_validation_error(f'Cannot change status from {order.status} to {new_status}')
+    
+    return jsonify(order.to_dict(mongo.db))
+
+@admin_bp.route('/orders/status/bulk', methods=['POST'])
+@jwt_required()
+@idempotent()
+def bulk_update_order_status():
+    error = admin_required()
+    if error:
+        return error
+    
+    data = request.get_json()
+    updates = data.get('updates') if isinstance(data, dict) else None
+    if not isinstance(updates, list) or not updates:
+        return handle_validation_error('Missing updates')
+    if len(updates) > MAX_BULK_STATUS_UPDATES:
+        return handle_validation_error(f'At most {MAX_BULK_STATUS_UPDATES} updates per request')
+    if not all(isinstance(update, dict) and isinstance(update.get('order_id'), str) for update in updates):
+        return handle_validation_error('Invalid updates')
+    
+    updated, errors = Order.bulk_update_status(
+        mongo.db, [(update['order_id'], update.get('status')) for update in updates]
+    )
+    
+    # One broadcast and one notification task per target status
+    for status, orders in updated.items():
+        order_ids = [order_id for order_id, _ in orders]
+        broadcast_order_updates(order_ids, status)
+        send_status_update_emails.delay(order_ids, status)
+    
+    return jsonify({
+        'updated': sum(len(orders) for orders in updated.values()),
+        'results': [
+            {
+                'order_id': update['order_id'],
+                'success': update['order_id'] not in errors,
+                'error': errors.get(update['order_id'])
+            }
+            for update in updates
+        ]
+    }), 200
+
+@admin_bp.route('/orders/bulk-cancel', methods=['POST'])
+@jwt_required()
+@idempotent()
+def bulk_cancel():
+    error = admin_required()
+    if error:
+        return error
+    
+    data = request.get_json()
+    order_ids = data.get('order_ids') if isinstance(data, dict) else None
+    if not isinstance(order_ids, list) or not order_ids:
+        return handle_validation_error('Missing order_ids')
+    if not all(isinstance(order_id, str) and ObjectId.is_valid(order_id) for order_id in order_ids):
+        return handle_validation_error('Invalid order_ids')
+    
+    task = bulk_cancel_orders.delay(order_ids)
+    
+    return jsonify({
+        'message': 'Bulk cancellation started',
+        'task_id': task.id
+    }), 202
+
+@admin_bp.route('/orders/bulk-cancel/<task_id>', methods=['GET'])
+@jwt_required()
+def bulk_cancel_status(task_id):
+    error = admin_required()
+    if error:
+        return error
+    
+    result = bulk_cancel_orders.AsyncResult(task_id)
+    progress = result.info if isinstance(result.info, dict) else {}
+    
+    return jsonify({
+        'task_id': task_id,
+        'state': result.state,
+        'processed': progress.get('processed', 0),
+        'cancelled': progress.get('cancelled', 0),
+        'total': progress.get('total')
+    })
 
 @admin_bp.route('/products/stats', methods=['GET'])
 @jwt_required()
@@ -195,14 +354,12 @@ def get_order_stats():
     if error:
         return error
         
-    total_orders = Order.count_all()
-    status_stats = Order.get_status_stats()
-    total_revenue = Order.get_total_revenue()
+    stats = Stats.get(mongo.db)
     
     return jsonify({
-        'total_orders': total_orders,
-        'status_stats': status_stats,
-        'total_revenue': total_revenue
+        'total_orders': stats['orders'],
+        'status_stats': stats['orders_by_status'],
+        'total_revenue': stats['revenue']
     })
 
 @admin_bp.route('/system/cleanup', methods=['POST'])
@@ -227,32 +384,25 @@ def get_dashboard():
     if error:
         return error
     
-    # Get statistics
-    total_users = request.db.users.count_documents({})
-    total_orders = request.db.orders.count_documents({})
-    total_products = request.db.products.count_documents({})
+    # Counters come from the incrementally maintained rollup document
+    stats = Stats.get(mongo.db)
     
     # Get recent orders
-    recent_orders = list(request.db.orders.find().sort('created_at', -1).limit(5))
-    recent_orders = [Order.from_dict(order).to_dict() for order in recent_orders]
-    
-    # Get order status counts
-    status_counts = {}
-    for status in ['pending', 'processing', 'shipped', 'delivered', 'cancelled']:
-        count = request.db.orders.count_documents({'status': status})
-        status_counts[status] = count
+    recent_orders = Order.find_all(mongo.db, per_page=5)
+    recent_orders = [order.to_dict(mongo.db) for order in recent_orders]
     
     # Get top products
-    top_products = list(request.db.products.find().sort('stock', -1).limit(5))
+    top_products = list(mongo.db.products.find().sort('stock', -1).limit(5))
     top_products = [Product.from_dict(product).to_dict() for product in top_products]
     
     return jsonify({
         'statistics': {
-            'total_users': total_users,
-            'total_orders': total_orders,
-            'total_products': total_products
+            'total_users': stats['users'],
+            'total_orders': stats['orders'],
+            'total_products': stats['products'],
+            'total_revenue': stats['revenue']
         },
         'recent_orders': recent_orders,
-        'status_counts': status_counts,
+        'status_counts': stats['orders_by_status'],
         'top_products': top_products
     }), 200 
\ No newline at end of file
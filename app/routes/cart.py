@@ -128,16 +128,14 @@ def apply_coupon():
     if not coupon:
         return handle_not_found_error('Coupon not found')
     
-    # Validate coupon
-    is_valid, error_message = coupon.validate(cart.get_total(mongo.db))
+    # Price the cart once, then validate and apply the coupon against it
+    priced_cart = cart.price(mongo.db)
+    is_valid, error_message = priced_cart.apply_coupon(coupon)
     if not is_valid:
         return handle_validation_error(error_message)
     
-    # Calculate discount
-    discount = coupon.calculate_discount(cart.get_total(mongo.db))
-    
     return jsonify({
         'message': 'Coupon applied successfully',
-        'discount': discount,
-        'cart': cart.to_dict(mongo.db)
+        'discount': priced_cart.discount,
+        'cart': priced_cart.to_dict()
     }), 200 
\ No newline at end of file
@@ -2,25 +2,39 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from app.models.cart import Cart
 from app.models.product import Product
-from app.utils.validators import validate_quantity
+from app.utils.validators import validate_quantity, validate_fields
+from app.utils.cache import not_modified, set_validators
+from app.utils.idempotency import idempotent
 from app.utils.error_handlers import handle_validation_error, handle_not_found_error
+from app import mongo
 
 carts_bp = Blueprint('carts', __name__)
 
+MAX_BATCH_OPERATIONS = 100
+
 @carts_bp.route('/', methods=['GET'])
 @jwt_required()
 def get_cart():
     user_id = get_jwt_identity()
-    cart = Cart.get_by_user_id(user_id)
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',')] if fields else None
+    if fields and not validate_fields(fields, Product.FIELDS):
+        return handle_validation_error('Invalid fields')
     
-    if not cart:
-        cart = Cart(user_id=user_id)
-        cart.save()
+    # Nothing is written until the first item is added
+    cart = Cart.find_by_user_id(user_id, mongo.db) or Cart(user_id=user_id)
     
-    return jsonify(cart.to_dict())
+    # Answer polling clients with a 304 before pricing or serializing anything
+    products = cart.load_products(mongo.db, fields)
+    etag = cart.etag(products, fields)
+    last_modified = cart.last_modified(products)
+    return not_modified(etag, last_modified) or set_validators(
+        jsonify(cart.to_dict(mongo.db, fields, products)), etag, last_modified
+    )
 
 @carts_bp.route('/items', methods=['POST'])
 @jwt_required()
+@idempotent()
 def add_item():
     user_id = get_jwt_identity()
     data = request.get_json()
@@ -30,20 +44,44 @@ def add_item():
         return handle_validation_error('Invalid quantity')
         
     # Get product
-    product = Product.get_by_id(data['product_id'])
+    product = Product.find_by_id(data.get('product_id'), mongo.db)
     if not product:
         return handle_not_found_error('Product not found')
         
-    # Get or create cart
-    cart = Cart.get_by_user_id(user_id)
-    if not cart:
-        cart = Cart(user_id=user_id)
+    # Get cart; a new one is only stored once an item is added
+    cart = Cart.find_by_user_id(user_id, mongo.db) or Cart(user_id=user_id)
+    
+    # Add item to cart in a single guarded update
+    if not cart.add_item(mongo.db, product.id, int(data['quantity'])):
+        return handle_validation_error('Insufficient stock')
+    
+    return jsonify(cart.to_dict(mongo.db))
+
+@carts_bp.route('/items/batch', methods=['POST'])
+@jwt_required()
+@idempotent()
+def batch_items():
+    user_id = get_jwt_identity()
+    data = request.get_json()
+    
+    # Validate input
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return handle_validation_error('Missing operations')
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return handle_validation_error(f'At most {MAX_BATCH_OPERATIONS} operations per batch')
+    if not all(isinstance(op, dict) for op in operations):
+        return handle_validation_error('Invalid operations')
+    
+    # Get cart; a new one is only stored once an item is added
+    cart = Cart.find_by_user_id(user_id, mongo.db) or Cart(user_id=user_id)
     
-    # Add item to cart
-    cart.add_item(product, data['quantity'])
-    cart.save()
+    results = cart.apply_operations(mongo.db, operations)
     
-    return jsonify(cart.to_dict())
+    return jsonify({
+        'results': results,
+        'cart': cart.to_dict(mongo.db)
+    })
 
 @carts_bp.route('/items/<product_id>', methods=['PUT'])
 @jwt_required()
@@ -56,16 +94,15 @@ def update_item(product_id):
         return handle_validation_error('Invalid quantity')
         
     # Get cart
-    cart = Cart.get_by_user_id(user_id)
+    cart = Cart.find_by_user_id(user_id, mongo.db)
     if not cart:
         return handle_not_found_error('Cart not found')
         
     # Update item quantity
-    if not cart.update_item_quantity(product_id, data['quantity']):
+    if not cart.update_item_quantity(mongo.db, product_id, int(data['quantity'])):
         return handle_not_found_error('Item not found in cart')
         
-    cart.save()
-    return jsonify(cart.to_dict())
+    return jsonify(cart.to_dict(mongo.db))
 
 @carts_bp.route('/items/<product_id>', methods=['DELETE'])
 @jwt_required()
@@ -73,16 +110,15 @@ def remove_item(product_id):
     user_id = get_jwt_identity()
     
     # Get cart
-    cart = Cart.get_by_user_id(user_id)
+    cart = Cart.find_by_user_id(user_id, mongo.db)
     if not cart:
         return handle_not_found_error('Cart not found')
         
     # Remove item
-    if not cart.remove_item(product_id):
+    if not cart.remove_item(mongo.db, product_id):
         return handle_not_found_error('Item not found in cart')
         
-    cart.save()
-    return jsonify(cart.to_dict())
+    return jsonify(cart.to_dict(mongo.db))
 
 @carts_bp.route('/', methods=['DELETE'])
 @jwt_required()
@@ -90,12 +126,11 @@ def clear_cart():
     user_id = get_jwt_identity()
     
     # Get cart
-    cart = Cart.get_by_user_id(user_id)
+    cart = Cart.find_by_user_id(user_id, mongo.db)
     if not cart:
         return handle_not_found_error('Cart not found')
         
     # Clear cart
-    cart.clear()
-    cart.save()
+    cart.clear(mongo.db)
     
-    return jsonify(cart.to_dict()) 
\ No newline at end of file
+    return jsonify(cart.to_dict(mongo.db))
\ No newline at end of file
@@ -2,7 +2,9 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from app.models.coupon import Coupon
 from app.models.user import User
-from app.utils.validators import validate_discount_value, validate_dates
+from app.utils.validators import validate_discount_value, validate_dates, validate_cursor
+from app.utils.pagination import next_cursor
+from app import mongo
 from app.utils.error_handlers import handle_validation_error, handle_not_found_error, handle_unauthorized_error
 
 coupons_bp = Blueprint('coupons', __name__)
@@ -11,22 +13,27 @@ coupons_bp = Blueprint('coupons', __name__)
 @jwt_required()
 def get_coupons():
     user_id = get_jwt_identity()
-    user = User.get_by_id(user_id)
+    user = User.find_by_id(user_id, mongo.db)
     
-    if not user.is_admin():
+    if not user or not user.is_admin():
         return handle_unauthorized_error('Admin access required')
         
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 10))
+    after = request.args.get('after')
+    
+    if after and not validate_cursor(after):
+        return handle_validation_error('Invalid cursor')
     
-    coupons = Coupon.find_all(page, per_page)
-    total = Coupon.count_all()
+    coupons = Coupon.find_all(mongo.db, page, per_page, after)
+    total = Coupon.count(mongo.db, request.args.get('total') == 'estimated')
     
     return jsonify({
         'coupons': [coupon.to_dict() for coupon in coupons],
         'total': total,
         'page': page,
-        'per_page': per_page
+        'per_page': per_page,
+        'next_cursor': next_cursor(coupons, per_page, 'created_at')
     })
 
 @coupons_bp.route('/<code>', methods=['GET'])
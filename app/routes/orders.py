@@ -1,12 +1,15 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.models.order import Order
-from app.models.cart import Cart
+from app.models.order import Order, OrderItem
+from app.models.checkout import Checkout, CheckoutError
 from app.models.product import Product
-from app.models.coupon import Coupon
 from app.models.user import User
 from app.utils.error_handlers import handle_validation_error, handle_not_found_error
-from app.utils.validators import validate_shipping_address
+from app.utils.validators import validate_shipping_address, validate_cursor, validate_fields
+from app.utils.pagination import next_cursor
+from app.utils.cache import not_modified, set_validators
+from app.utils.idempotency import idempotent
+from app import mongo
 from app.tasks import send_order_confirmation_email
 
 orders_bp = Blueprint('orders', __name__)
@@ -17,32 +20,50 @@ def get_orders():
     user_id = get_jwt_identity()
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 10))
+    after = request.args.get('after')
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',')] if fields else None
     
-    orders = Order.find_by_user_id(user_id, page, per_page)
-    total = Order.count_by_user_id(user_id)
+    if after and not validate_cursor(after):
+        return handle_validation_error('Invalid cursor')
+    if fields and not validate_fields(fields, OrderItem.PRODUCT_FIELDS):
+        return handle_validation_error('Invalid fields')
+    
+    orders = Order.find_by_user_id(user_id, mongo.db, page, per_page, after)
+    total = Order.count_by_user_id(user_id, mongo.db)
     
     return jsonify({
-        'orders': [order.to_dict() for order in orders],
+        'orders': [order.to_dict(mongo.db, fields) for order in orders],
         'total': total,
         'page': page,
-        'per_page': per_page
+        'per_page': per_page,
+        'next_cursor': next_cursor(orders, per_page, 'created_at')
     })
 
 @orders_bp.route('/<order_id>', methods=['GET'])
 @jwt_required()
 def get_order(order_id):
     user_id = get_jwt_identity()
-    order = Order.get_by_id(order_id)
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',')] if fields else None
+    if fields and not validate_fields(fields, OrderItem.PRODUCT_FIELDS):
+        return handle_validation_error('Invalid fields')
+    
+    order = Order.find_by_id(order_id, mongo.db)
     
     if not order:
         return handle_not_found_error('Order not found')
     if order.user_id != user_id:
         return handle_not_found_error('Order not found')
-        
-    return jsonify(order.to_dict())
+    
+    etag = order.etag(fields)
+    return not_modified(etag, order.updated_at) or set_validators(
+        jsonify(order.to_dict(mongo.db, fields)), etag, order.updated_at
+    )
 
 @orders_bp.route('/', methods=['POST'])
 @jwt_required()
+@idempotent()
 def create_order():
     user_id = get_jwt_identity()
     data = request.get_json()
@@ -50,77 +71,59 @@ def create_order():
     # Validate shipping address
     if not validate_shipping_address(data.get('shipping_address')):
         return handle_validation_error('Invalid shipping address')
-        
-    # Get cart
-    cart = Cart.get_by_user_id(user_id)
-    if not cart or not cart.items:
-        return handle_validation_error('Cart is empty')
-        
-    # Apply coupon if provided
-    coupon = None
-    if data.get('coupon_code'):
-        coupon = Coupon.get_by_code(data['coupon_code'])
-        if not coupon or not coupon.is_valid(cart.total_amount):
-            return handle_validation_error('Invalid or expired coupon')
-    
-    # Create order
-    order = Order(
-        user_id=user_id,
-        items=cart.items,
-        total_amount=cart.total_amount,
-        shipping_address=data['shipping_address'],
-        coupon=coupon
-    )
-    order.save()
     
-    # Clear cart
-    cart.clear()
-    cart.save()
+    # Reserve stock, redeem coupon, create order and clear cart in one pipeline
+    checkout = Checkout(mongo.db, mongo.cx, user_id)
+    try:
+        order = checkout.run(data['shipping_address'], data.get('coupon_code'))
+    except CheckoutError as e:
+        return handle_validation_error(str(e))
     
     # Send confirmation email
     send_order_confirmation_email.delay(user_id, order.id)
     
-    return jsonify(order.to_dict()), 201
+    response = jsonify(order.to_dict(mongo.db))
+    response.headers['Server-Timing'] = checkout.server_timing()
+    return response, 201
 
 @orders_bp.route('/<order_id>/cancel', methods=['POST'])
 @jwt_required()
 def cancel_order(order_id):
     user_id = get_jwt_identity()
-    order = Order.get_by_id(order_id)
+    order = Order.find_by_id(order_id, mongo.db)
     
     if not order:
         return handle_not_found_error('Order not found')
     if order.user_id != user_id:
         return handle_not_found_error('Order not found')
-    if not order.can_cancel():
+    
+    # Status check and stock restoration happen atomically in the model
+    if not order.cancel(mongo.db):
         return handle_validation_error('Order cannot be cancelled')
-        
-    order.cancel()
-    order.save()
     
-    return jsonify(order.to_dict())
+    return jsonify(order.to_dict(mongo.db))
 
 @orders_bp.route('/<order_id>/status', methods=['PUT'])
 @jwt_required()
 def update_order_status(order_id):
     current_user_id = get_jwt_identity()
-    user = User.find_by_id(request.db, current_user_id)
+    user = User.find_by_id(current_user_id, mongo.db)
     
-    if not user.is_admin():
+    if not user or not user.is_admin():
         return handle_validation_error('Unauthorized'), 403
     
     data = request.get_json()
     if not data or not data.get('status'):
         return handle_validation_error('Missing status')
     
-    order = Order.find_by_id(request.db, order_id)
+    order = Order.find_by_id(order_id, mongo.db)
     if not order:
         return handle_validation_error('Order not found')
     
-    if order.update_status(request.db, data['status']):
+    if order.update_status(mongo.db, data['status']):
         return jsonify({
             'message': 'Order status updated successfully',
-            'order': order.to_dict()
+            'order': order.to_dict(mongo.db)
         }), 200
     
     return handle_validation_error('Invalid status') 
\ No newline at end of file
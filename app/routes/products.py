@@ -1,50 +1,83 @@
-from flask import Blueprint, request, jsonify
+import csv
+import io
+import json
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from pymongo.errors import BulkWriteError
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.models.product import Product
+from app.models.product import Product, CATALOG_VERSION_KEY, LIST_VERSION_KEY
 from app.models.user import User
-from app.utils.validators import validate_price, validate_stock
+from app.utils.validators import validate_price, validate_stock, validate_cursor, validate_fields
+from app.utils.pagination import next_cursor
 from app.utils.error_handlers import handle_validation_error, handle_unauthorized_error, handle_not_found_error
-from app import mongo, cache
+from app.utils.cache import cached_response, add_cache_tags, make_etag, not_modified, set_validators
+from app import mongo
 
 products_bp = Blueprint('products', __name__)
 
+PRODUCT_UPDATE_FIELDS = ['sku', 'name', 'description', 'price', 'category', 'stock', 'image_url']
+
+BULK_CHUNK_SIZE = 1000
+BULK_REQUIRED_FIELDS = ['sku', 'name', 'description', 'price', 'category', 'stock']
+
 @products_bp.route('/', methods=['GET'])
-@cache.cached(timeout=300)
+@cached_response(timeout=3600, guard=CATALOG_VERSION_KEY)
 def get_products():
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 10))
     category = request.args.get('category')
     search = request.args.get('search')
+    after = request.args.get('after')
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',')] if fields else None
+    
+    if after and not validate_cursor(after):
+        return handle_validation_error('Invalid cursor')
+    if fields and not validate_fields(fields, Product.FIELDS):
+        return handle_validation_error('Invalid fields')
     
-    # Build query
-    query = {}
-    if category:
-        query['category'] = category
+    # Tag the cached page with every version counter that can change it
     if search:
-        query['$or'] = [
-            {'name': {'$regex': search, '$options': 'i'}},
-            {'description': {'$regex': search, '$options': 'i'}}
-        ]
+        add_cache_tags(CATALOG_VERSION_KEY)
+    elif category:
+        add_cache_tags(Product.category_version_key(category))
+    else:
+        add_cache_tags(LIST_VERSION_KEY)
     
-    # Get products
-    products = Product.find(query, page, per_page)
-    total = Product.count(query)
+    # Get products, ranked by relevance when searching
+    cursor = None
+    if search:
+        products = Product.search(mongo.db, search, category, page, per_page, fields)
+    else:
+        products = Product.find_all(mongo.db, category, page, per_page, after, fields)
+        cursor = next_cursor(products, per_page)
+    total = Product.count(mongo.db, category, search, request.args.get('total') == 'estimated')
+    add_cache_tags(*[Product.version_key(product.id) for product in products])
     
     return jsonify({
-        'products': [product.to_dict() for product in products],
+        'products': [product.to_dict(fields) if fields else product.to_json() for product in products],
         'total': total,
         'page': page,
-        'per_page': per_page
+        'per_page': per_page,
+        'next_cursor': cursor
     }), 200
 
 @products_bp.route('/<product_id>', methods=['GET'])
-@cache.cached(timeout=300)
+@cached_response(timeout=3600)
 def get_product(product_id):
-    product = Product.get_by_id(product_id)
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',')] if fields else None
+    if fields and not validate_fields(fields, Product.FIELDS):
+        return handle_validation_error('Invalid fields')
+    
+    add_cache_tags(Product.version_key(product_id))
+    product = Product.find_by_id(product_id, mongo.db)
     if not product:
         return handle_not_found_error('Product not found')
     
-    return jsonify(product.to_dict()), 200
+    etag = make_etag(product.id, product.updated_at, fields)
+    return not_modified(etag, product.updated_at) or set_validators(
+        jsonify(product.to_dict(fields)), etag, product.updated_at
+    )
 
 @products_bp.route('/', methods=['POST'])
 @jwt_required()
@@ -74,13 +107,11 @@ def create_product():
         price=data['price'],
         category=data['category'],
         stock=data['stock'],
-        image_url=data.get('image_url')
+        image_url=data.get('image_url'),
+        sku=data.get('sku')
     )
     product.save(mongo.db)
     
-    # Clear cache
-    cache.delete_memoized(get_products)
-    
     return jsonify({
         'message': 'Product created successfully',
         'product': product.to_dict()
@@ -95,7 +126,7 @@ def update_product(product_id):
     if not user or user.role != 'admin':
         return handle_unauthorized_error('Admin access required')
     
-    product = Product.get_by_id(product_id)
+    product = Product.find_by_id(product_id, mongo.db)
     if not product:
         return handle_not_found_error('Product not found')
     
@@ -107,14 +138,8 @@ def update_product(product_id):
     if 'stock' in data and not validate_stock(data['stock']):
         return handle_validation_error('Invalid stock')
     
-    # Update product
-    for key, value in data.items():
-        setattr(product, key, value)
-    product.save()
-    
-    # Clear cache
-    cache.delete_memoized(get_products)
-    cache.delete_memoized(get_product, product_id)
+    # Update product; cached pages are invalidated through their tags
+    product.update(mongo.db, **{k: v for k, v in data.items() if k in PRODUCT_UPDATE_FIELDS})
     
     return jsonify({
         'message': 'Product updated successfully',
@@ -130,15 +155,11 @@ def delete_product(product_id):
     if not user or user.role != 'admin':
         return handle_unauthorized_error('Admin access required')
     
-    product = Product.get_by_id(product_id)
+    product = Product.find_by_id(product_id, mongo.db)
     if not product:
         return handle_not_found_error('Product not found')
     
-    product.delete()
-    
-    # Clear cache
-    cache.delete_memoized(get_products)
-    cache.delete_memoized(get_product, product_id)
+    product.delete(mongo.db)
     
     return jsonify({
         'message': 'Product deleted successfully'
@@ -153,7 +174,7 @@ def update_stock(product_id):
     if not user or user.role != 'admin':
         return handle_unauthorized_error('Admin access required')
     
-    product = Product.get_by_id(product_id)
+    product = Product.find_by_id(product_id, mongo.db)
     if not product:
         return handle_not_found_error('Product not found')
     
@@ -171,4 +192,117 @@ def update_stock(product_id):
             'product': product.to_dict()
         }), 200
     
-    return handle_validation_error('Failed to update stock') 
\ No newline at end of file
+    return handle_validation_error('Failed to update stock')
+
+def read_bulk_rows(stream, content_type):
+    """Yield (line_number, row) pairs from an NDJSON or CSV request body."""
+    text = io.TextIOWrapper(stream, encoding='utf-8')
+    if content_type.startswith('text/csv'):
+        for line_number, row in enumerate(csv.DictReader(text), start=2):
+            yield line_number, row
+        return
+
+    for line_number, line in enumerate(text, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+def validate_bulk_row(row):
+    if not isinstance(row, dict):
+        return 'Invalid JSON'
+    if not all(row.get(k) not in (None, '') for k in BULK_REQUIRED_FIELDS):
+        return 'Missing required fields'
+    if not validate_price(row['price']):
+        return 'Invalid price'
+    if not validate_stock(row['stock']):
+        return 'Invalid stock'
+    return None
+
+@products_bp.route('/bulk', methods=['POST'])
+@jwt_required()
+def bulk_import_products():
+    # Check if user is admin
+    current_user_id = get_jwt_identity()
+    user = User.find_by_id(current_user_id, mongo.db)
+    if not user or user.role != 'admin':
+        return handle_unauthorized_error('Admin access required')
+    
+    inserted = 0
+    updated = 0
+    errors = []
+    chunk = []
+    
+    def flush(rows):
+        nonlocal inserted, updated
+        try:
+            result = Product.bulk_upsert(mongo.db, [row for _, row in rows]).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            for error in result['writeErrors']:
+                errors.append({'line': rows[error['index']][0], 'error': error['errmsg']})
+        inserted += result['nUpserted']
+        updated += result['nModified']
+    
+    # Rows are validated and written chunk by chunk as the body streams in
+    for line_number, row in read_bulk_rows(request.stream, request.content_type or ''):
+        error = validate_bulk_row(row)
+        if error:
+            errors.append({'line': line_number, 'error': error})
+            continue
+        chunk.append((line_number, row))
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    
+    return jsonify({
+        'message': 'Bulk import completed',
+        'inserted': inserted,
+        'updated': updated,
+        'errors': errors
+    }), 200
+
+@products_bp.route('/export', methods=['GET'])
+@jwt_required()
+def export_products():
+    # Check if user is admin
+    current_user_id = get_jwt_identity()
+    user = User.find_by_id(current_user_id, mongo.db)
+    if not user or user.role != 'admin':
+        return handle_unauthorized_error('Admin access required')
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ['ndjson', 'csv']:
+        return handle_validation_error('Invalid format')
+    
+    cursor = Product.export_cursor(mongo.db, request.args.get('category'))
+    
+    def generate_ndjson():
+        for product_data in cursor:
+            yield json.dumps(Product.from_dict(product_data).to_dict()) + '\n'
+    
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=Product.FIELDS)
+        writer.writeheader()
+        for product_data in cursor:
+            writer.writerow(Product.from_dict(product_data).to_dict())
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if export_format == 'csv':
+        body, mimetype = generate_csv(), 'text/csv'
+    else:
+        body, mimetype = generate_ndjson(), 'application/x-ndjson'
+    
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=products.{export_format}'}
+    )
@@ -4,7 +4,11 @@ from app import create_app, mail, mongo
 from app.models.order import Order
 from app.models.user import User
 from app.models.coupon import Coupon
+from app.models.cart import Cart, cart_store
+from app.models.stats import Stats
+from config import Config
 from datetime import datetime
+from bson import ObjectId
 
 # Initialize Celery
 celery = Celery('tasks', broker='redis://localhost:6379/2')
@@ -18,8 +22,35 @@ celery.conf.update(
     result_serializer='json',
     timezone='UTC',
     enable_utc=True,
+    beat_schedule={
+        'flush-cart-store': {
+            'task': 'app.tasks.flush_cart_store',
+            'schedule': Config.CART_FLUSH_INTERVAL,
+        },
+        'rebuild-stats': {
+            'task': 'app.tasks.rebuild_stats',
+            'schedule': 24 * 3600,
+        },
+        'archive-orders': {
+            'task': 'app.tasks.archive_orders',
+            'schedule': 24 * 3600,
+        },
+        'archive-abandoned-carts': {
+            'task': 'app.tasks.archive_abandoned_carts',
+            'schedule': 24 * 3600,
+        },
+    },
 )
 
+flask_app = None
+
+def get_app():
+    """Flask app for tasks that need an application context (created lazily)."""
+    global flask_app
+    if flask_app is None:
+        flask_app = create_app()
+    return flask_app
+
 @celery.task
 def send_order_confirmation_email(user_email, order_id):
     """Send order confirmation email to user."""
@@ -138,4 +169,117 @@ def cleanup_expired_coupons():
         return len(expired_coupons)
     except Exception as e:
         print(f"Error cleaning up expired coupons: {str(e)}")
-        return 0 
\ No newline at end of file
+        return 0
+
+@celery.task
+def flush_cart_store():
+    """Write carts changed in the Redis cart store back to Mongo."""
+    if not cart_store:
+        return 0
+    try:
+        with get_app().app_context():
+            return cart_store.flush(mongo.db)
+    except Exception as e:
+        print(f"Error flushing cart store: {str(e)}")
+        return 0
+
+
+@celery.task
+def archive_abandoned_carts():
+    """Archive carts untouched for CART_ABANDON_DAYS days."""
+    try:
+        with get_app().app_context():
+            return Cart.archive_abandoned(mongo.db, Config.CART_ABANDON_DAYS)
+    except Exception as e:
+        print(f"Error archiving abandoned carts: {str(e)}")
+        return 0
+
+@celery.task
+def backfill_order_snapshots():
+    """One-off migration: add product snapshots to existing order lines."""
+    try:
+        with get_app().app_context():
+            return Order.backfill_snapshots(mongo.db)
+    except Exception as e:
+        print(f"Error backfilling order snapshots: {str(e)}")
+        return 0
+
+@celery.task(bind=True)
+def bulk_cancel_orders(self, order_ids, chunk_size=500):
+    """Cancel orders chunk by chunk, reporting progress through the task state."""
+    cancelled = 0
+    with get_app().app_context():
+        for start in range(0, len(order_ids), chunk_size):
+            cancelled += Order.cancel_many(mongo.db, order_ids[start:start + chunk_size])
+            self.update_state(state='PROGRESS', meta={
+                'processed': min(start + chunk_size, len(order_ids)),
+                'cancelled': cancelled,
+                'total': len(order_ids)
+            })
+    return {'processed': len(order_ids), 'cancelled': cancelled, 'total': len(order_ids)}
+
+@celery.task
+def rebuild_stats():
+    """Recompute the dashboard rollup from scratch to correct any drift."""
+    try:
+        with get_app().app_context():
+            Stats.rebuild(mongo.db)
+            return True
+    except Exception as e:
+        print(f"Error rebuilding stats: {str(e)}")
+        return False
+
+@celery.task
+def send_status_update_emails(order_ids, new_status):
+    """Notify the owners of a batch of orders about a status change over one SMTP connection."""
+    sent = 0
+    try:
+        with get_app().app_context():
+            orders = list(mongo.db.orders.find(
+                {'_id': {'$in': [ObjectId(order_id) for order_id in order_ids]}},
+                {'user_id': 1}
+            ))
+            user_ids = [ObjectId(order_data['user_id']) for order_data in orders if ObjectId.is_valid(order_data['user_id'])]
+            users = {
+                str(user_data['_id']): user_data
+                for user_data in mongo.db.users.find({'_id': {'$in': user_ids}}, {'email': 1, 'name': 1})
+            }
+
+            with mail.connect() as connection:
+                for order_data in orders:
+                    user_data = users.get(order_data['user_id'])
+                    if not user_data:
+                        continue
+                    msg = Message(
+                        subject='Order Status Update',
+                        recipients=[user_data['email']]
+                    )
+                    msg.body = f"""
+        Dear {user_data['name']},
+        
+        Your order status has been updated:
+        
+        Order ID: {order_data['_id']}
+        New Status: {new_status}
+        
+        You can track your order at: /orders/{order_data['_id']}
+        
+        Best regards,
+        Your E-Commerce Team
+        """
+                    connection.send(msg)
+                    sent += 1
+        return sent
+    except Exception as e:
+        print(f"Error sending status update emails: {str(e)}")
+        return sent
+
+@celery.task
+def archive_orders():
+    """Move delivered and cancelled orders older than ORDER_ARCHIVE_DAYS to orders_archive."""
+    try:
+        with get_app().app_context():
+            return Order.archive(mongo.db, Config.ORDER_ARCHIVE_DAYS)
+    except Exception as e:
+        print(f"Error archiving orders: {str(e)}")
+        return 0
@@ -1,7 +1,14 @@
+from flask import Response, current_app, g, request
 from flask_caching import Cache
 from functools import wraps
+from collections import OrderedDict
+from redis import RedisError
+from app import redis_client, cache as response_cache
 import hashlib
 import json
+import threading
+import time
+from datetime import timezone
 
 cache = Cache(config={
     'CACHE_TYPE': 'redis',
@@ -38,4 +45,180 @@ def clear_cache_for_function(function_name):
 
 def clear_all_cache():
     """Clear all cache entries."""
-    cache.clear() 
\ No newline at end of file
+    cache.clear()
+
+class LocalCache:
+    """Thread-safe in-process cache with LRU eviction and per-entry TTL.
+
+    Entries can be stored with a version; a lookup made with a different
+    version is treated as a miss, which lets a shared version counter
+    invalidate copies held by every worker process.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, entry_version, expires_at = entry
+            if expires_at < time.monotonic() or entry_version != version:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, version=None):
+        with self._lock:
+            self._entries[key] = (value, version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def get_versions(keys):
+    """Read version counters from Redis, or None if Redis is unavailable."""
+    if not keys:
+        return []
+    try:
+        return [int(value or 0) for value in redis_client.mget(keys)]
+    except RedisError:
+        return None
+
+def get_version(key):
+    versions = get_versions([key])
+    return versions[0] if versions is not None else None
+
+def bump_versions(*keys):
+    """Increment version counters so cached copies of the keys become stale."""
+    if not keys:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.incr(key)
+        pipe.execute()
+    except RedisError:
+        pass
+
+def collection_version_key(collection):
+    return f'{collection.name}:version'
+
+def cached_count(collection, query=None, timeout=30):
+    """count_documents shared across workers through Redis.
+
+    The key embeds the collection's version counter, so any write that
+    calls bump_versions(collection_version_key(...)) invalidates every
+    cached total for that collection at once.
+    """
+    query = query or {}
+    version = get_version(collection_version_key(collection))
+    if version is None:
+        return collection.count_documents(query)
+
+    digest = hashlib.md5(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()
+    key = f'count:{collection.name}:{version}:{digest}'
+    try:
+        total = redis_client.get(key)
+        if total is not None:
+            return int(total)
+    except RedisError:
+        return collection.count_documents(query)
+
+    total = collection.count_documents(query)
+    try:
+        redis_client.setex(key, timeout, total)
+    except RedisError:
+        pass
+    return total
+
+def estimated_count(collection, query=None):
+    """Cheap total: collection metadata for unfiltered lists, cached count otherwise."""
+    if not query:
+        return collection.estimated_document_count()
+    return cached_count(collection, query)
+
+def make_etag(*parts):
+    """Strong ETag for a representation identified by parts (ids, timestamps, versions)."""
+    return hashlib.md5(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def not_modified(etag, last_modified=None):
+    """304 response if the request's validators still match, else None.
+
+    Call it before loading or serializing anything the validators do not
+    need, so unchanged resources cost only the lookup that built the etag.
+    """
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif last_modified and request.if_modified_since:
+        matched = last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+    else:
+        matched = False
+    if not matched:
+        return None
+    return set_validators(Response(status=304), etag, last_modified)
+
+def set_validators(response, etag, last_modified=None):
+    response = current_app.make_response(response)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return response
+
+def add_cache_tags(*tags):
+    """Tag the @cached_response being built; call before reading the data the tags cover."""
+    recorded = g.setdefault('cache_tags', {})
+    tags = [tag for tag in tags if tag not in recorded]
+    versions = get_versions(tags)
+    recorded.update(zip(tags, versions if versions is not None else [None] * len(tags)))
+
+def cached_response(timeout=None, guard=None):
+    """Cache a view's 200 responses until the version of one of its tags changes."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            cache_key = f'view:{request.full_path}'
+            entry = response_cache.get(cache_key)
+            if entry:
+                tags = list(entry['tags'])
+                if get_versions(tags) == list(entry['tags'].values()):
+                    # Conditional requests are answered here without running the view
+                    response = Response(entry['body'], status=200, mimetype=entry['mimetype'], headers=entry['headers'])
+                    return response.make_conditional(request)
+
+            g.cache_tags = {}
+            guard_version = get_version(guard) if guard else None
+            response = current_app.make_response(f(*args, **kwargs))
+
+            tags = g.cache_tags
+            cacheable = response.status_code == 200 and tags and None not in tags.values()
+            if cacheable and guard:
+                # Covers tags only known after the read, e.g. the products on a page
+                cacheable = guard_version is not None and get_version(guard) == guard_version
+            if cacheable:
+                response_cache.set(cache_key, {
+                    'tags': tags,
+                    'body': response.get_data(),
+                    'mimetype': response.mimetype,
+                    'headers': {
+                        header: response.headers[header]
+                        for header in ('ETag', 'Last-Modified') if header in response.headers
+                    }
+                }, timeout=timeout)
+            return response
+        return decorated_function
+    return decorator
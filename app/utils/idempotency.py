@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import json
+import time
+from functools import wraps
+from flask import Response, current_app, request
+from flask_jwt_extended import get_jwt_identity
+from redis import RedisError
+from app import redis_client
+from app.utils.error_handlers import handle_validation_error
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+def idempotent(ttl=24 * 3600, lock_ttl=60, wait=5):
+    """Replay the recorded response for a repeated Idempotency-Key; apply below @jwt_required()."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+            if not idempotency_key:
+                return f(*args, **kwargs)
+            if len(idempotency_key) > 255:
+                return handle_validation_error('Invalid Idempotency-Key')
+
+            key = f'idempotency:{get_jwt_identity()}:{request.method}:{request.path}:{idempotency_key}'
+            fingerprint = hashlib.md5(request.get_data()).hexdigest()
+
+            try:
+                while not redis_client.set(key, json.dumps({'fingerprint': fingerprint}), nx=True, ex=lock_ttl):
+                    replayed = replay(key, fingerprint, wait)
+                    if replayed is not None:
+                        return replayed
+            except RedisError:
+                return f(*args, **kwargs)
+
+            try:
+                response = current_app.make_response(f(*args, **kwargs))
+            except Exception:
+                release(key)
+                raise
+
+            if response.status_code >= 500 or response.is_streamed:
+                release(key)
+                return response
+            try:
+                redis_client.set(key, json.dumps({
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'body': base64.b64encode(response.get_data()).decode(),
+                    'mimetype': response.mimetype,
+                    'headers': {
+                        header: value for header, value in response.headers.items()
+                        if header in ('Location', 'ETag', 'Last-Modified')
+                    }
+                }), ex=ttl)
+            except RedisError:
+                pass
+            return response
+        return decorated_function
+    return decorator
+
+def replay(key, fingerprint, wait):
+    deadline = time.monotonic() + wait
+    while True:
+        entry = redis_client.get(key)
+        if entry is None:
+            # The first attempt failed and released the key; claim it again
+            return None
+
+        entry = json.loads(entry)
+        if entry['fingerprint'] != fingerprint:
+            return handle_validation_error('Idempotency-Key was already used with a different request body', 422)
+        if 'status' in entry:
+            response = Response(
+                base64.b64decode(entry['body']),
+                status=entry['status'],
+                mimetype=entry['mimetype'],
+                headers=entry['headers']
+            )
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        if time.monotonic() >= deadline:
+            return handle_validation_error('A request with this Idempotency-Key is still being processed', 409)
+        time.sleep(0.1)
+
+def release(key):
+    try:
+        redis_client.delete(key)
+    except RedisError:
+        pass
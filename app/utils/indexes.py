@@ -0,0 +1,127 @@
+from datetime import datetime
+from pymongo.errors import ConnectionFailure, PyMongoError
+from app.models.cart import Cart
+from app.models.coupon import Coupon
+from app.models.order import Order
+from app.models.product import Product
+from app.models.user import User
+
+# Collection name -> model whose INDEXES declare that collection's indexes
+INDEX_REGISTRY = {
+    'users': User,
+    'carts': Cart,
+    'orders': Order,
+    'orders_archive': Order,
+    'coupons': Coupon,
+    'products': Product
+}
+
+# Model finders whose queries must each be answered by an index. They run
+# against a recording database (see find_collscans), so the plans checked
+# are those of the queries the finders really issue.
+FINDERS = [
+    ('User.find_by_email', lambda db: User.find_by_email('user@example.com', db)),
+    ('Cart.find_by_user_id', lambda db: Cart.find_by_user_id('user', db)),
+    ('Order.find_by_user_id', lambda db: Order.find_by_user_id('user', db)),
+    ('Order.find_all', lambda db: Order.find_all(db)),
+    ('Order.find_all(status)', lambda db: Order.find_all(db, {'status': 'pending'})),
+    ('Order.export_cursor', lambda db: Order.export_cursor(db, start=datetime(2000, 1, 1))),
+    ('Order.archive', lambda db: Order.archive(db, 365)),
+    ('Coupon.find_by_code', lambda db: Coupon.find_by_code('CODE', db)),
+    ('Coupon.find_all', lambda db: Coupon.find_all(db)),
+    ('Product.find_all(category)', lambda db: Product.find_all(db, 'query-plan-check')),
+    ('Product.search', lambda db: Product.search(db, 'term'))
+]
+
+def ensure_indexes(db):
+    """Create every declared index; returns ({collection: [index names]}, {collection: error}).
+
+    create_indexes is a no-op for indexes that already exist, so this is
+    safe to run on every start. Each collection is handled on its own, so
+    one failure (e.g. existing data violating a unique index) does not
+    leave the others unindexed.
+    """
+    created = {}
+    errors = {}
+    for name, model in INDEX_REGISTRY.items():
+        try:
+            created[name] = db[name].create_indexes(model.INDEXES)
+        except ConnectionFailure as e:
+            # The remaining collections would wait out the same timeout
+            errors.update({collection: str(e) for collection in INDEX_REGISTRY if collection not in created})
+            break
+        except PyMongoError as e:
+            errors[name] = str(e)
+    return created, errors
+
+def plan_stages(plan):
+    """All stage names in an explain() plan tree."""
+    stages = [plan.get('stage')]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += plan_stages(child)
+    return stages
+
+class RecordedCursor:
+    """Stands in for a cursor: applies sort/skip/limit to the real one but yields nothing."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        method = getattr(self._cursor, name)
+
+        def chained(*args, **kwargs):
+            method(*args, **kwargs)
+            return self
+        return chained
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        raise StopIteration
+
+class RecordingCollection:
+    """Stands in for a collection: records the finds issued against it and returns no documents."""
+
+    def __init__(self, collection, cursors):
+        self._collection = collection
+        self._cursors = cursors
+        self.name = collection.name
+
+    def find(self, *args, **kwargs):
+        cursor = self._collection.find(*args, **kwargs)
+        self._cursors.append(cursor)
+        return RecordedCursor(cursor)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        self.find(filter, *args, **kwargs).limit(1)
+        return None
+
+    def create_indexes(self, indexes):
+        return self._collection.create_indexes(indexes)
+
+class RecordingDatabase:
+    def __init__(self, db):
+        self._db = db
+        self.cursors = []
+
+    def __getitem__(self, name):
+        return RecordingCollection(self._db[name], self.cursors)
+
+    __getattr__ = __getitem__
+
+def find_collscans(db):
+    """Finders with a query whose winning plan scans a whole collection, as 'finder (collection)'."""
+    collscans = []
+    for name, finder in FINDERS:
+        recording = RecordingDatabase(db)
+        finder(recording)
+        for cursor in recording.cursors:
+            winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+            if 'COLLSCAN' in plan_stages(winning_plan):
+                collscans.append(f'{name} ({cursor.collection.name})')
+    return collscans
@@ -0,0 +1,53 @@
+import base64
+import json
+from datetime import datetime
+from bson import ObjectId
+
+def encode_cursor(doc_id, sort_value=None):
+    """Encode the position of the last returned document as an opaque token."""
+    payload = {'id': str(doc_id)}
+    if isinstance(sort_value, datetime):
+        payload['dt'] = sort_value.isoformat()
+    elif sort_value is not None:
+        payload['k'] = sort_value
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Return (ObjectId, sort_value) for a cursor token, or raise ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+        doc_id = ObjectId(payload['id'])
+        if 'dt' in payload:
+            return doc_id, datetime.fromisoformat(payload['dt'])
+        return doc_id, payload.get('k')
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def keyset_filter(token, sort_field='_id', direction=1):
+    """Build a range filter that resumes right after the cursor position.
+
+    Results must be sorted by (sort_field, _id) in the given direction so
+    the filter can be answered by an index range scan instead of a skip.
+    """
+    doc_id, sort_value = decode_cursor(token)
+    op = '$gt' if direction == 1 else '$lt'
+    if sort_field == '_id':
+        return {'_id': {op: doc_id}}
+    return {'$or': [
+        {sort_field: {op: sort_value}},
+        {sort_field: sort_value, '_id': {op: doc_id}}
+    ]}
+
+def merge_filters(query, extra):
+    if not query:
+        return extra
+    return {'$and': [query, extra]}
+
+def next_cursor(items, per_page, sort_attr=None):
+    """Cursor for the page after items, or None when this was the last page."""
+    if not items or len(items) < per_page:
+        return None
+    last = items[-1]
+    return encode_cursor(last.id, getattr(last, sort_attr) if sort_attr else None)
@@ -0,0 +1,43 @@
+import json
+import re
+import secrets
+from flask.json.provider import DefaultJSONProvider
+
+class RawJSON:
+    """Already-encoded JSON embedded verbatim when a response is serialized."""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+def encode(obj):
+    """Compact, key-sorted encoding used for cached fragments."""
+    return json.dumps(obj, separators=(',', ':'), sort_keys=True)
+
+class FragmentJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that splices RawJSON fragments into the output.
+
+    Fragments are swapped for placeholder strings during the normal C
+    encoder pass and substituted afterwards, so payloads without fragments
+    cost exactly what they did before.
+    """
+
+    def dumps(self, obj, **kwargs):
+        fragments = []
+        # A fresh token per call, so strings in the payload cannot pose as placeholders
+        token = secrets.token_hex(8)
+
+        def default(o):
+            if isinstance(o, RawJSON):
+                fragments.append(o.data)
+                return f'\0{token}:{len(fragments) - 1}\0'
+            return self.default(o)
+
+        kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        rv = json.dumps(obj, default=default, **kwargs)
+        if fragments:
+            placeholder = re.compile(r'"\\u0000' + token + r':(\d+)\\u0000"')
+            rv = placeholder.sub(lambda match: fragments[int(match.group(1))], rv)
+        return rv
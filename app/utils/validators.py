@@ -1,5 +1,6 @@
 import re
 from datetime import datetime
+from app.utils.pagination import decode_cursor
 
 def validate_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -60,4 +61,14 @@ def validate_dates(start_date, end_date):
             return start <= end
         return True
     except (ValueError, TypeError):
-        return False 
\ No newline at end of file
+        return False 
+
+def validate_cursor(cursor):
+    try:
+        decode_cursor(cursor)
+        return True
+    except ValueError:
+        return False
+
+def validate_fields(fields, allowed):
+    return bool(fields) and all(field in allowed for field in fields)
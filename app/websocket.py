@@ -1,11 +1,9 @@
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask_socketio import emit, join_room, leave_room
 from flask_jwt_extended import decode_token
 from functools import wraps
 from app.models.order import Order
 from app.models.user import User
-from app import mongo
-
-socketio = SocketIO()
+from app import mongo, socketio
 
 def authenticated_only(f):
     @wraps(f)
@@ -87,6 +85,15 @@ def broadcast_order_update(order_id, status):
         'status': status
     }, room=f'order_{order_id}')
 
+def broadcast_order_updates(order_ids, status):
+    """Broadcast a batch of status changes: one event per order room, one for admins."""
+    for order_id in order_ids:
+        broadcast_order_update(order_id, status)
+    socketio.emit('order_status_batch', {
+        'order_ids': order_ids,
+        'status': status
+    }, room='admin')
+
 def broadcast_new_order(order_data):
     """Broadcast new order notification to admin room."""
     socketio.emit('new_order', order_data, room='admin')
@@ -12,6 +12,8 @@ class Config:
     
     # MongoDB Configuration
     MONGO_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/ecommerce')
+    # Off by default: run `flask ensure-indexes` on deploy instead of on every worker start
+    MONGO_ENSURE_INDEXES = os.getenv('MONGO_ENSURE_INDEXES', 'false').lower() == 'true'
     
     # Redis Configuration
     REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
@@ -42,6 +44,14 @@ class Config:
     CACHE_TYPE = 'redis'
     CACHE_REDIS_URL = REDIS_URL
     CACHE_DEFAULT_TIMEOUT = 300  # 5 minutes
+    PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', 10000))
+    PRODUCT_CACHE_TTL = int(os.getenv('PRODUCT_CACHE_TTL', 60))  # seconds
+    
+    # Cart Storage: 'mongo' writes through, 'redis' keeps hot carts in Redis
+    CART_BACKEND = os.getenv('CART_BACKEND', 'mongo')
+    CART_FLUSH_INTERVAL = int(os.getenv('CART_FLUSH_INTERVAL', 30))  # seconds
+    CART_ABANDON_DAYS = int(os.getenv('CART_ABANDON_DAYS', 30))
+    ORDER_ARCHIVE_DAYS = int(os.getenv('ORDER_ARCHIVE_DAYS', 365))
     
     # Celery Configuration
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/2')
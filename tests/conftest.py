@@ -0,0 +1,55 @@
+import fakeredis
+import mongomock
+import pytest
+from flask_jwt_extended import create_access_token
+import app as app_package
+import app.utils.cache
+import app.utils.idempotency
+import app.models.stats
+from app import create_app, mongo
+from app.models.user import User
+from config import Config
+
+class TestConfig(Config):
+    TESTING = True
+    CACHE_TYPE = 'SimpleCache'
+    MONGO_ENSURE_INDEXES = False
+    RATELIMIT_ENABLED = False
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeRedis()
+    for module in (app_package, app.utils.cache, app.utils.idempotency):
+        monkeypatch.setattr(module, 'redis_client', client)
+    return client
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    # mongomock has no snapshot sessions
+    monkeypatch.setattr(app.models.stats, '_snapshot_reads_supported', False)
+    return mongomock.MongoClient().ecommerce_test
+
+@pytest.fixture
+def flask_app(monkeypatch, redis, mongo_db):
+    flask_app = create_app(TestConfig)
+    monkeypatch.setattr(mongo, 'db', mongo_db)
+    return flask_app
+
+@pytest.fixture
+def client(flask_app):
+    return flask_app.test_client()
+
+@pytest.fixture
+def auth_headers(flask_app):
+    def make_headers(user_id):
+        with flask_app.app_context():
+            return {'Authorization': f'Bearer {create_access_token(identity=user_id)}'}
+    return make_headers
+
+@pytest.fixture
+def admin_headers(flask_app, mongo_db, auth_headers):
+    with flask_app.app_context():
+        admin = User('admin@example.com', 'password', 'Admin')
+        admin.role = 'admin'
+        admin.save(mongo_db)
+    return auth_headers(admin.id)
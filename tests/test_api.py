@@ -1 +1,20 @@
- 
\ No newline at end of file
+import os
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from app.utils.indexes import ensure_indexes, find_collscans
+
+@pytest.fixture
+def db():
+    client = MongoClient(os.getenv('TEST_MONGODB_URI', 'mongodb://localhost:27017'), serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except PyMongoError:
+        pytest.skip('MongoDB is not available')
+    yield client.ecommerce_test
+    client.drop_database('ecommerce_test')
+
+def test_finder_queries_use_indexes(db):
+    _, errors = ensure_indexes(db)
+    assert errors == {}
+    assert find_collscans(db) == []
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+import pytest
+from bson import ObjectId
+import app.models.cart
+from app.models.cart import Cart
+from app.models.cart_store import RedisCartStore, DIRTY_KEY, FLUSHING_KEY
+
+@pytest.fixture
+def store(monkeypatch, redis):
+    store = RedisCartStore(redis)
+    monkeypatch.setattr(app.models.cart, 'cart_store', store)
+    return store
+
+def make_cart(mongo_db, user_id, items=(), updated_at=None):
+    now = updated_at or datetime.utcnow()
+    cart_data = {
+        '_id': ObjectId(),
+        'user_id': user_id,
+        'items': [{'product_id': product_id, 'quantity': quantity} for product_id, quantity in items],
+        'created_at': now,
+        'updated_at': now
+    }
+    mongo_db.carts.insert_one(cart_data)
+    return cart_data
+
+def quantities(cart_data):
+    return {item['product_id']: item['quantity'] for item in cart_data['items']}
+
+def test_scripts_warm_cart_from_mongo(store, mongo_db):
+    make_cart(mongo_db, 'user', [('a', 1)])
+
+    assert quantities(store.add_item(mongo_db, 'user', 'a', 2, 5)) == {'a': 3}
+    assert store.client.sismember(DIRTY_KEY, 'user')
+
+def test_add_item_rolls_back_over_stock(store, mongo_db):
+    make_cart(mongo_db, 'user', [('a', 4)])
+
+    assert store.add_item(mongo_db, 'user', 'a', 2, 5) is None
+    assert store.add_item(mongo_db, 'user', 'b', 6, 5) is None
+    assert quantities(store.load(mongo_db, 'user')) == {'a': 4}
+
+def test_set_remove_and_clear(store, mongo_db):
+    make_cart(mongo_db, 'user', [('a', 1), ('b', 2)])
+
+    assert quantities(store.set_quantity(mongo_db, 'user', 'a', 3)) == {'a': 3, 'b': 2}
+    assert store.set_quantity(mongo_db, 'user', 'c', 1) is None
+    assert quantities(store.remove_item(mongo_db, 'user', 'b')) == {'a': 3}
+    assert store.remove_item(mongo_db, 'user', 'b') is None
+    assert store.clear(mongo_db, 'user')['items'] == []
+
+def test_replace_items_checks_updated_at(store, mongo_db):
+    make_cart(mongo_db, 'user', [('a', 1)])
+    cart_data = store.load(mongo_db, 'user')
+
+    assert store.replace_items(mongo_db, 'user', [{'product_id': 'b', 'quantity': 2}], cart_data['updated_at'] - timedelta(seconds=1)) is None
+    replaced = store.replace_items(mongo_db, 'user', [{'product_id': 'b', 'quantity': 2}], cart_data['updated_at'])
+    assert quantities(replaced) == {'b': 2}
+
+def test_warm_keeps_a_cart_already_in_redis(store, mongo_db):
+    cart_data = make_cart(mongo_db, 'user', [('a', 1)])
+    store.add_item(mongo_db, 'user', 'a', 1, 5)
+
+    assert not store.warm(cart_data)
+    assert quantities(store.load(mongo_db, 'user')) == {'a': 2}
+
+def test_remove_quantities_keeps_later_changes(store, mongo_db):
+    make_cart(mongo_db, 'user', [('a', 2)])
+    store.add_item(mongo_db, 'user', 'a', 1, 5)
+    store.add_item(mongo_db, 'user', 'b', 1, 5)
+
+    assert store.remove_quantities('user', [('a', 2)])
+    assert quantities(store.load(mongo_db, 'user')) == {'a': 1, 'b': 1}
+    assert not store.remove_quantities('nobody', [('a', 1)])
+
+def test_flush_writes_dirty_carts(store, mongo_db):
+    make_cart(mongo_db, 'user', [('a', 1)])
+    store.add_item(mongo_db, 'user', 'a', 1, 5)
+
+    assert store.flush(mongo_db) == 1
+    assert quantities(mongo_db.carts.find_one({'user_id': 'user'})) == {'a': 2}
+    assert not store.client.exists(DIRTY_KEY) and not store.client.exists(FLUSHING_KEY)
+
+def test_flush_retries_batch_left_by_crashed_flush(store, mongo_db):
+    make_cart(mongo_db, 'user', [('a', 1)])
+    store.add_item(mongo_db, 'user', 'a', 1, 5)
+    # A flush that died after claiming the dirty set leaves it renamed
+    store.client.rename(DIRTY_KEY, FLUSHING_KEY)
+    store.add_item(mongo_db, 'user', 'a', 1, 5)
+
+    assert store.flush(mongo_db) == 1
+    assert quantities(mongo_db.carts.find_one({'user_id': 'user'})) == {'a': 3}
+    assert store.client.sismember(DIRTY_KEY, 'user')
+
+def test_targeted_flush_keeps_carts_changed_mid_flush_dirty(store, mongo_db, monkeypatch):
+    make_cart(mongo_db, 'user', [('a', 1)])
+    store.add_item(mongo_db, 'user', 'a', 1, 5)
+    read_many = store._read_many
+
+    def read_then_change(user_ids):
+        carts = read_many(user_ids)
+        monkeypatch.setattr(store, '_read_many', read_many)
+        store.add_item(mongo_db, 'user', 'a', 1, 5)
+        return carts
+    monkeypatch.setattr(store, '_read_many', read_then_change)
+
+    assert store.flush(mongo_db, ['user']) == 1
+    assert quantities(mongo_db.carts.find_one({'user_id': 'user'})) == {'a': 2}
+    assert store.client.sismember(DIRTY_KEY, 'user')
+
+    assert store.flush(mongo_db, ['user']) == 1
+    assert quantities(mongo_db.carts.find_one({'user_id': 'user'})) == {'a': 3}
+    assert not store.client.sismember(DIRTY_KEY, 'user')
+
+def test_archive_skips_carts_changed_in_redis(store, mongo_db):
+    old = datetime.utcnow() - timedelta(days=60)
+    for user_id in ('idle', 'active'):
+        make_cart(mongo_db, user_id, [('a', 1)], updated_at=old)
+        Cart.find_by_user_id(user_id, mongo_db)
+    # Edited in Redis but not yet flushed: Mongo still has the old copy
+    store.flush = lambda db, user_ids=None: 0
+    store.add_item(mongo_db, 'active', 'a', 1, 5)
+
+    assert Cart.archive_abandoned(mongo_db, 30) == 1
+    assert [cart_data['user_id'] for cart_data in mongo_db.carts.find()] == ['active']
+    assert quantities(store.load(mongo_db, 'active')) == {'a': 2}
+    assert not store.client.exists('cart:idle')
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import pytest
+from flask import jsonify
+from flask_jwt_extended import jwt_required
+from app.models.product import Product
+from app.utils.idempotency import idempotent
+
+@pytest.fixture
+def products(flask_app, mongo_db):
+    with flask_app.app_context():
+        return [Product(f'Product {index}', 'd', 10, 'tools', 5).save(mongo_db) for index in range(2)]
+
+@pytest.fixture
+def flaky_view(flask_app):
+    calls = []
+
+    @flask_app.route('/test/flaky', methods=['POST'])
+    @jwt_required()
+    @idempotent(wait=0)
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            return jsonify({'error': 'Server Error'}), 500
+        return jsonify({'call': len(calls)}), 201
+    return calls
+
+def test_batch_operations(client, auth_headers, products):
+    headers = auth_headers('user')
+    client.post('/api/carts/items', json={'product_id': products[0].id, 'quantity': 1}, headers=headers)
+
+    response = client.post('/api/carts/items/batch', json={'operations': [
+        {'op': 'update', 'product_id': products[0].id, 'quantity': 3},
+        {'op': 'add', 'product_id': products[1].id, 'quantity': 2},
+        {'op': 'add', 'product_id': products[1].id, 'quantity': 9},
+        {'op': 'remove', 'product_id': 'missing'},
+        {'op': 'add', 'product_id': ['list'], 'quantity': 1},
+        {'op': 'remove', 'product_id': {'$ne': None}}
+    ]}, headers=headers)
+
+    assert response.status_code == 200
+    assert [result['error'] for result in response.json['results']] == [
+        None, None, 'Insufficient stock', 'Item not found in cart', 'Invalid product_id', 'Invalid product_id'
+    ]
+    assert {item['product']['id']: item['quantity'] for item in response.json['cart']['items']} == {
+        products[0].id: 3,
+        products[1].id: 2
+    }
+
+def test_idempotent_request_is_replayed(client, auth_headers, products):
+    headers = dict(auth_headers('user'), **{'Idempotency-Key': 'add-1'})
+    body = {'product_id': products[0].id, 'quantity': 2}
+
+    first = client.post('/api/carts/items', json=body, headers=headers)
+    second = client.post('/api/carts/items', json=body, headers=headers)
+
+    assert second.status_code == first.status_code == 200
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.json == first.json
+    assert client.get('/api/carts/', headers=auth_headers('user')).json['items'][0]['quantity'] == 2
+
+def test_idempotency_key_reused_with_another_body(client, auth_headers, products):
+    headers = dict(auth_headers('user'), **{'Idempotency-Key': 'add-1'})
+
+    client.post('/api/carts/items', json={'product_id': products[0].id, 'quantity': 1}, headers=headers)
+    response = client.post('/api/carts/items', json={'product_id': products[0].id, 'quantity': 2}, headers=headers)
+
+    assert response.status_code == 422
+
+def test_idempotency_key_in_progress(client, auth_headers, redis, flaky_view):
+    body = json.dumps({}).encode()
+    redis.set('idempotency:user:POST:/test/flaky:busy', json.dumps({'fingerprint': hashlib.md5(body).hexdigest()}))
+
+    response = client.post('/test/flaky', data=body, content_type='application/json',
+                           headers=dict(auth_headers('user'), **{'Idempotency-Key': 'busy'}))
+
+    assert response.status_code == 409
+    assert flaky_view == []
+
+def test_server_error_releases_idempotency_key(client, auth_headers, flaky_view):
+    headers = dict(auth_headers('user'), **{'Idempotency-Key': 'retry'})
+
+    assert client.post('/test/flaky', json={}, headers=headers).status_code == 500
+    retried = client.post('/test/flaky', json={}, headers=headers)
+    replayed = client.post('/test/flaky', json={}, headers=headers)
+
+    assert retried.status_code == 201 and retried.json == {'call': 2}
+    assert replayed.headers['Idempotent-Replayed'] == 'true'
+    assert len(flaky_view) == 2
@@ -0,0 +1,88 @@
+from datetime import datetime
+import pytest
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+import app.models.checkout as checkout
+from app.models.checkout import Checkout, CheckoutError
+from app.models.coupon import Coupon
+from app.models.order import Order
+from app.models.product import Product
+
+ADDRESS = {'street': '1 Main St', 'city': 'Town', 'state': 'ST', 'country': 'US', 'zip_code': '12345'}
+
+class StandaloneClient:
+    def start_session(self):
+        raise OperationFailure('Transaction numbers are only allowed on a replica set member or mongos', checkout.ILLEGAL_OPERATION)
+
+@pytest.fixture
+def shop(flask_app, mongo_db, monkeypatch):
+    monkeypatch.setattr(checkout, '_transactions_supported', True)
+    with flask_app.app_context():
+        products = [Product(f'Product {index}', 'd', 10, 'tools', 5).save(mongo_db) for index in range(2)]
+        Coupon('SAVE', 'fixed', 5, usage_limit=1).save(mongo_db)
+        mongo_db.carts.insert_one({
+            'user_id': 'user',
+            'items': [{'product_id': products[0].id, 'quantity': 2}, {'product_id': products[1].id, 'quantity': 1}],
+            'created_at': datetime.utcnow(),
+            'updated_at': datetime.utcnow()
+        })
+        yield products
+
+def stock(mongo_db):
+    return [product_data['stock'] for product_data in mongo_db.products.find().sort('_id', 1)]
+
+def coupon_uses(mongo_db):
+    return mongo_db.coupons.find_one({'code': 'SAVE'})['usage_count']
+
+def test_checkout_falls_back_without_transactions(shop, mongo_db):
+    order = Checkout(mongo_db, StandaloneClient(), 'user').run(ADDRESS, 'save')
+
+    assert not checkout._transactions_supported
+    assert order.total_amount == 25
+    assert stock(mongo_db) == [3, 4]
+    assert coupon_uses(mongo_db) == 1
+    assert mongo_db.carts.find_one({'user_id': 'user'})['items'] == []
+    assert mongo_db.orders.count_documents({}) == 1
+
+def test_checkout_fails_on_insufficient_stock(shop, mongo_db):
+    mongo_db.products.update_one({'_id': mongo_db.products.find_one({'name': 'Product 1'})['_id']}, {'$set': {'stock': 0}})
+
+    with pytest.raises(CheckoutError, match='Insufficient stock'):
+        Checkout(mongo_db, StandaloneClient(), 'user').run(ADDRESS, 'save')
+    assert stock(mongo_db) == [5, 0]
+    assert coupon_uses(mongo_db) == 0
+    assert mongo_db.orders.count_documents({}) == 0
+
+def test_checkout_releases_stock_when_coupon_is_used_up(shop, mongo_db, monkeypatch):
+    # Another checkout takes the last use after this one validated the coupon
+    redeem = Coupon.redeem
+
+    def redeem_after_rival(self, db, session=None):
+        db.coupons.update_one({'_id': ObjectId(self.id)}, {'$inc': {'usage_count': 1}})
+        return redeem(self, db, session)
+    monkeypatch.setattr(Coupon, 'redeem', redeem_after_rival)
+
+    with pytest.raises(CheckoutError, match='Coupon usage limit reached'):
+        Checkout(mongo_db, StandaloneClient(), 'user').run(ADDRESS, 'save')
+    assert stock(mongo_db) == [5, 5]
+    assert coupon_uses(mongo_db) == 1
+    assert mongo_db.orders.count_documents({}) == 0
+
+def test_checkout_undoes_everything_when_cart_changes(shop, mongo_db, monkeypatch):
+    save = Order.save
+
+    def save_then_edit_cart(self, db, session=None):
+        result = save(self, db, session)
+        db.carts.update_one({'user_id': 'user'}, {
+            '$push': {'items': {'product_id': 'late', 'quantity': 1}},
+            '$set': {'updated_at': datetime.utcnow()}
+        })
+        return result
+    monkeypatch.setattr(Order, 'save', save_then_edit_cart)
+
+    with pytest.raises(CheckoutError, match='Cart changed during checkout'):
+        Checkout(mongo_db, StandaloneClient(), 'user').run(ADDRESS, 'save')
+    assert stock(mongo_db) == [5, 5]
+    assert coupon_uses(mongo_db) == 0
+    assert mongo_db.orders.count_documents({}) == 0
+    assert len(mongo_db.carts.find_one({'user_id': 'user'})['items']) == 3
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+from bson import ObjectId
+import app.routes.admin as admin_routes
+from app.models.order import Order, OrderItem
+from app.models.product import Product
+from app.models.stats import Stats
+
+def test_bulk_status_update(flask_app, client, mongo_db, admin_headers, monkeypatch):
+    emails = []
+    monkeypatch.setattr(admin_routes.send_status_update_emails, 'delay', lambda order_ids, status: emails.append((order_ids, status)))
+
+    with flask_app.app_context():
+        product = Product('Widget', 'A widget', 10, 'tools', 20).save(mongo_db)
+        Stats.rebuild(mongo_db)
+        orders = [Order('user', [OrderItem.from_product(product, 1)], {}, 10).save(mongo_db) for _ in range(3)]
+        orders[1].update_status(mongo_db, 'processing')
+
+    response = client.post('/api/admin/orders/status/bulk', json={'updates': [
+        {'order_id': orders[0].id, 'status': 'processing'},
+        {'order_id': orders[1].id, 'status': 'shipped'},
+        {'order_id': orders[2].id, 'status': 'delivered'},
+        {'order_id': 'not-an-id', 'status': 'shipped'}
+    ]}, headers=admin_headers)
+
+    assert response.status_code == 200
+    assert response.json['updated'] == 2
+    assert [result['success'] for result in response.json['results']] == [True, True, False, False]
+    assert sorted(status for _, status in emails) == ['processing', 'shipped']
+    assert [order['status'] for order in mongo_db.orders.find().sort('_id', 1)] == ['processing', 'shipped', 'pending']
+    assert mongo_db.orders.count_documents({'status_batch': {'$exists': True}}) == 0
+    with flask_app.app_context():
+        assert Stats.get(mongo_db)['orders_by_status'] == Stats.rebuild(mongo_db)['orders_by_status']
+
+def test_stats_rebuild_keeps_increments_made_meanwhile(mongo_db, monkeypatch):
+    Product('Widget', 'A widget', 10, 'tools', 20).save(mongo_db)
+    Stats.rebuild(mongo_db)
+    mongo_db.stats.update_one({'_id': Stats.DOCUMENT_ID}, {'$inc': {'products': 5}})
+    read = Stats._read
+
+    def read_then_increment(db, session):
+        result = read(db, session)
+        Stats.increment(db, {'users': 1, 'orders_by_status.pending': 1})
+        return result
+    monkeypatch.setattr(Stats, '_read', read_then_increment)
+
+    stats = Stats.rebuild(mongo_db)
+    assert stats['products'] == 1
+    assert stats['users'] == 1
+    assert stats['orders_by_status']['pending'] == 1
+
+def test_archive_pages_by_updated_at(flask_app, mongo_db):
+    with flask_app.app_context():
+        product = Product('Widget', 'A widget', 10, 'tools', 20).save(mongo_db)
+        orders = [Order('user', [OrderItem.from_product(product, 1)], {}, 10).save(mongo_db) for _ in range(5)]
+    old = datetime.utcnow() - timedelta(days=400)
+    # Several orders share an updated_at, so paging must also order by _id
+    for index, order in enumerate(orders):
+        status = 'pending' if index == 2 else 'delivered'
+        mongo_db.orders.update_one({'_id': ObjectId(order.id)}, {'$set': {'status': status, 'updated_at': old + timedelta(days=index // 2)}})
+
+    with flask_app.app_context():
+        assert Order.archive(mongo_db, 365, batch_size=2) == 4
+    assert [order_data['_id'] for order_data in mongo_db.orders.find()] == [ObjectId(orders[2].id)]
+    assert mongo_db.orders_archive.count_documents({}) == 4
@@ -0,0 +1,57 @@
+from bson import ObjectId
+from app.models.product import Product, RESERVATION_TAGS
+
+def stock(mongo_db):
+    return [product_data['stock'] for product_data in mongo_db.products.find().sort('_id', 1)]
+
+def test_reserve_stock_takes_every_line(mongo_db, redis):
+    first = Product('First', 'd', 10, 'tools', 5).save(mongo_db)
+    second = Product('Second', 'd', 10, 'tools', 2).save(mongo_db)
+
+    assert Product.reserve_stock(mongo_db, [(first.id, 2), (second.id, 1), (first.id, 1)])
+    assert stock(mongo_db) == [2, 1]
+
+def test_reserve_stock_keeps_few_reservation_tags(mongo_db, redis):
+    product = Product('Widget', 'd', 10, 'tools', 100).save(mongo_db)
+
+    for _ in range(RESERVATION_TAGS + 5):
+        assert Product.reserve_stock(mongo_db, [(product.id, 1)])
+    assert len(mongo_db.products.find_one()['reservations']) == RESERVATION_TAGS
+
+def test_reserve_stock_compensates_partial_failure(mongo_db, redis):
+    first = Product('First', 'd', 10, 'tools', 5).save(mongo_db)
+    second = Product('Second', 'd', 10, 'tools', 1).save(mongo_db)
+    updated_at = mongo_db.products.find_one({'_id': ObjectId(first.id)})['updated_at']
+
+    assert not Product.reserve_stock(mongo_db, [(first.id, 2), (second.id, 2)])
+    assert stock(mongo_db) == [5, 1]
+    # The restored product gets a new updated_at, so fragments and ETags change
+    assert mongo_db.products.find_one({'_id': ObjectId(first.id)})['updated_at'] > updated_at
+
+def test_reserve_stock_rejects_missing_products(mongo_db, redis):
+    product = Product('Widget', 'd', 10, 'tools', 5).save(mongo_db)
+
+    assert not Product.reserve_stock(mongo_db, [(product.id, 1), (str(ObjectId()), 1)])
+    assert stock(mongo_db) == [5]
+    assert mongo_db.products.count_documents({}) == 1
+    assert mongo_db.products.find_one()['reservations'] == []
+
+def test_reserve_stock_rejects_non_positive_quantities(mongo_db, redis):
+    product = Product('Widget', 'd', 10, 'tools', 5).save(mongo_db)
+
+    assert not Product.reserve_stock(mongo_db, [(product.id, -10)])
+    assert not Product.reserve_stock(mongo_db, [(product.id, 0)])
+    assert stock(mongo_db) == [5]
+
+def test_list_pages_with_keyset_cursor(flask_app, client, mongo_db):
+    with flask_app.app_context():
+        ids = [Product(f'Product {index}', 'd', 10, 'tools', 5).save(mongo_db).id for index in range(5)]
+
+    first = client.get('/api/products/?per_page=2').json
+    second = client.get(f'/api/products/?per_page=2&after={first["next_cursor"]}').json
+    last = client.get(f'/api/products/?per_page=2&after={second["next_cursor"]}').json
+
+    pages = [first, second, last]
+    assert [product['id'] for page in pages for product in page['products']] == ids
+    assert last['next_cursor'] is None
+    assert client.get('/api/products/?after=not-a-cursor').status_code == 400
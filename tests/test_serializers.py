@@ -0,0 +1,10 @@
+import json
+from app.utils.serializers import RawJSON
+
+def test_fragments_are_spliced_verbatim(flask_app):
+    rv = flask_app.json.dumps({'items': [RawJSON('{"a":1}'), RawJSON('{"b":2}')]})
+    assert json.loads(rv) == {'items': [{'a': 1}, {'b': 2}]}
+
+def test_strings_shaped_like_placeholders_are_left_alone(flask_app):
+    payload = {'name': '\u00000\u0000', 'fragment': RawJSON('{"a":1}')}
+    assert json.loads(flask_app.json.dumps(payload)) == {'name': '\u00000\u0000', 'fragment': {'a': 1}}